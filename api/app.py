@@ -1,6 +1,3 @@
-import atexit
-import functools
-import gc
 import socket
 import database
 import flask
@@ -18,32 +15,70 @@ from statsd import statsd
 from flask import Flask
 from ConfigParser import ConfigParser
 from functools import wraps
-from cassandra.cluster import Cluster as CassandraCluster
-from cassandra.auth import PlainTextAuthProvider
+from cassandra.cluster import NoHostAvailable
 
 from util import TIME_BOT_COMPETITION_START
 from util import timeline
 from util import cursor
+from util import keyset_page
+from util import paged
 from util import make_json_response
+from util import stream_json_array
+from util import stream_query
 from util import not_implemented
 from util import temporal
+from util import immutable_history
 from util import get_time_anchor
 from util import get_current_virtual_time
 from util import translate_alpha_time_to_virtual_time
 from util import translate_virtual_time_to_alpha_time
 from util import nearest_scan
+from util import find_nearest_scan
+from util import scan_window
+from util import clamp_virtual_time
 from util import disabled_after_competition_ends
 from util import beta_predicate_tweets
+from util import participant_set
 from util import beta_predicate_users
 from util import beta_predicate_observations
+from util import is_participant
 from util import we_are_out_of_beta
 from util import timed
+from util import coalesced
+from util import get_tags
 from util import track_pageview
 from util import process_guess_scores
-from util import get_score_bonus
-
+from util import score_guesses
+from util import score_guessed_users
+
+from cache import LRUCache
+from history_cache import HistoryCache
+from tweet_histogram import TweetHistogram
+from cassandra_pool import CassandraSessionPool
+from edges import register_edge_statements
+from edges import followers_window
+from edges import followers_statement
+from edges import explore_window
+from edges import explore_statement
+from edges import fetch_page
+from edges import fetch_followers_concurrently
+from edges import iterate_followers
+from edges import diff_edges
+from edges import BATCH_MAX_USERS
+from edges import STATEMENT_SNAPSHOT
+from edges import InvalidPagingState
+from follower_graph import FollowerGraphCache
 from formatter import UserFormatter, TweetFormatter, GuessFormatter, EdgeFormatter
 from search import Search
+from projection import project_tweets
+from projection import project_users
+from entity_index import EntityIndex
+from text_index import TEXT_BACKENDS
+from text_index import TEXT_BACKEND_SUBSTRING
+from scorecard import apply_guess
+from scorecard import read_scorecard
+from scorecard import get_timeline
+from scorecard import get_leaderboard
 
 from detectionteam import DetectionTeam
 from guess import Guess
@@ -63,27 +98,86 @@ app.config['SQLALCHEMY_DATABASE_URI'] = 'postgresql://%s:%s@/pacsocial?host=%s'
 app.config['SQLALCHEMY_ECHO'] = False
 database.db.init_app(app)
 
+cassandra_pool = CassandraSessionPool(
+    [config.get('cassandra', 'contact')],
+    'smisc',
+    config.get('cassandra', 'username'),
+    config.get('cassandra', 'password'),
+    executor_threads=(config.getint('cassandra', 'executor_threads') if config.has_option('cassandra', 'executor_threads') else 8),
+    local_dc=(config.get('cassandra', 'local_dc') if config.has_option('cassandra', 'local_dc') else None)
+)
+register_edge_statements(cassandra_pool)
+
+# off unless configured: every worker process scans and holds its own copy of each retained graph
+follower_graphs = FollowerGraphCache(
+    app,
+    cassandra_pool,
+    STATEMENT_SNAPSHOT,
+    retain=(config.getint('cassandra', 'graph_snapshots') if config.has_option('cassandra', 'graph_snapshots') else 0)
+)
+
+search_text_backend = config.get('search', 'text_backend') if config.has_option('search', 'text_backend') else TEXT_BACKEND_SUBSTRING
+
+if search_text_backend not in TEXT_BACKENDS:
+    raise ValueError('search.text_backend must be one of %s' % (', '.join(TEXT_BACKENDS),))
+
+# fraction of searches whose per-stage timings go to statsd
+search_trace_sample_rate = config.getfloat('search', 'trace_sample_rate') if config.has_option('search', 'trace_sample_rate') else 0.01
+
+# off unless configured: every worker process loads and holds its own copy of the postings
+if config.has_option('search', 'entity_index') and config.getboolean('search', 'entity_index'):
+    entity_index = EntityIndex(app, participant_set)
+else:
+    entity_index = None
+
+HISTORY_CACHE_MAX_ENTRY_BYTES = 16 * 1024 * 1024
+
+# responses for virtual times that can no longer change; set history_max_bytes to 0 to turn the cache off
+history_cache_max_bytes = config.getint('cache', 'history_max_bytes') if config.has_option('cache', 'history_max_bytes') else 256 * 1024 * 1024
+history_margin = config.getint('cache', 'history_margin') if config.has_option('cache', 'history_margin') else 3600
+
+if history_cache_max_bytes > 0:
+    history_cache = HistoryCache(
+        history_cache_max_bytes,
+        min(history_cache_max_bytes, HISTORY_CACHE_MAX_ENTRY_BYTES),
+        directory=(config.get('cache', 'history_directory') if config.has_option('cache', 'history_directory') else None)
+    )
+else:
+    history_cache = None
+
+# participant tweet counts per bucket of this many virtual seconds, for /tweets/count
+tweet_histogram = TweetHistogram(
+    participant_set,
+    TIME_BOT_COMPETITION_START,
+    time_bucket=(config.getint('cache', 'count_bucket_seconds') if config.has_option('cache', 'count_bucket_seconds') else 60)
+)
+
 def cassandrafied(f):
     @wraps(f)
     def decorator(*args, **kwargs):
-        cluster = CassandraCluster([config.get('cassandra', 'contact')], auth_provider=PlainTextAuthProvider(username=config.get('cassandra', 'username'), password=config.get('cassandra', 'password')), executor_threads=50)
-        session = cluster.connect('smisc')
-        kwargs['cassandra_cluster'] = session
+        kwargs['cassandra_cluster'] = cassandra_pool.get_session()
         try:
             return f(*args, **kwargs)
-        finally:
-            session.shutdown()
-            cluster.shutdown()
-            # grumble grumble grumble, cassandra people caused memory leaks by assuming atexit is called
-            for ext in atexit.__dict__['_exithandlers']:
-                (handler, args, kwargs) = ext
-                if isinstance(handler, functools.partial) and len(handler.args) > 0 and isinstance(handler.args[0], CassandraCluster) and handler.func.func_name == '_shutdown_cluster':
-                    atexit.__dict__['_exithandlers'].remove(ext)
-            gc.collect()
-
+        except NoHostAvailable:
+            # drop the session so the next request reconnects instead of reusing a dead pool
+            cassandra_pool.invalidate()
+            raise
+        except InvalidPagingState:
+            return flask.make_response('', 400)
 
     return decorator
 
+CREDENTIAL_CACHE_SIZE = 256
+CREDENTIAL_CACHE_TTL = 300
+REJECTED_CREDENTIAL_CACHE_SIZE = 4096
+REJECTED_CREDENTIAL_CACHE_TTL = 30
+
+# bearer token -> team id; rejected tokens live in their own cache so guessing can't evict real teams. Every worker
+# process has its own copy and nothing clears it, so a changed or revoked team password takes up to
+# CREDENTIAL_CACHE_TTL seconds to stop working, and a new one up to REJECTED_CREDENTIAL_CACHE_TTL to start.
+team_credentials = LRUCache(CREDENTIAL_CACHE_SIZE, ttl=CREDENTIAL_CACHE_TTL)
+rejected_credentials = LRUCache(REJECTED_CREDENTIAL_CACHE_SIZE, ttl=REJECTED_CREDENTIAL_CACHE_TTL)
+
 def require_passcode(f):
     @wraps(f)
     def decorator(*args, **kwargs):
@@ -91,20 +185,50 @@ def require_passcode(f):
             return flask.make_response('', 401)
 
         password = flask.request.headers['Authorization'].replace('Bearer ', '')
-        team = DetectionTeam.query.filter(DetectionTeam.password == password).first()
 
-        if team is None:
+        if rejected_credentials.get(password) is not None:
             return flask.make_response('', 403)
 
-        kwargs['team_id'] = team.id
+        team_id = team_credentials.get(password)
+
+        if team_id is None:
+            team = DetectionTeam.query.filter(DetectionTeam.password == password).first()
+
+            if team is None:
+                rejected_credentials.set(password, True)
+                return flask.make_response('', 403)
+
+            team_id = team.id
+            team_credentials.set(password, team_id)
+
+        kwargs['team_id'] = team_id
 
         return f(*args, **kwargs)
             
     return decorator
 
+def has_admin_passcode():
+    password = flask.request.headers['Authorization'].replace('Bearer ', '')
+
+    return config.has_option('admin', 'passcode') and password == config.get('admin', 'passcode')
+
+def require_admin_passcode(f):
+    @wraps(f)
+    def decorator(*args, **kwargs):
+        if 'Authorization' not in flask.request.headers:
+            return flask.make_response('', 401)
+
+        if not has_admin_passcode():
+            return flask.make_response('', 403)
+
+        return f(*args, **kwargs)
+
+    return decorator
+
 @app.route('/clock', methods=['GET'], defaults={'vtime': None})
 @app.route('/clock/<vtime>', methods=['GET'])
 @timed('page.clock.render')
+@coalesced
 @make_json_response
 @temporal
 @track_pageview
@@ -137,105 +261,199 @@ def show_clock(vtime):
 @timed('page.edges_followers.render')
 @make_json_response
 @temporal
+@immutable_history(history_cache, history_margin, Scan.SCAN_TYPE_FOLLOWERS)
 @timeline()
 @nearest_scan(Scan.SCAN_TYPE_FOLLOWERS)
+@paged
 @cassandrafied
 @track_pageview
-def timeless_list_followers(cassandra_cluster, vtime, user_id, max_id, since_id, since_count, max_scan_id, min_scan_id):
+def timeless_list_followers(cassandra_cluster, vtime, user_id, max_id, since_id, since_count, max_scan_id, min_scan_id, paging_state):
     user = beta_predicate_users(TwitterUser.query.filter(TwitterUser.twitter_id == user_id)).first()
 
     if user is not None:
-        id_condition = ""
-        ids = []
+        (wanted_min_id, wanted_max_id) = followers_window(since_id, max_id, min_scan_id, max_scan_id)
+        snapshot = follower_graphs.get(min_scan_id, max_scan_id)
 
-        wanted_min_id = since_id+1
-        wanted_max_id = max_id+1
+        if snapshot is not None and paging_state is None:
+            (rows, flask.g.next_edge_id) = snapshot.followers(user_id, wanted_min_id, wanted_max_id, since_count)
+        else:
+            (statement, params) = followers_statement(cassandra_pool, user_id, wanted_min_id, wanted_max_id)
+            (rows, flask.g.next_paging_state) = fetch_page(cassandra_cluster, statement, params, since_count, paging_state)
 
-        if min_scan_id is not None and max_scan_id is not None:
-            wanted_min_id = max(since_id+1, min_scan_id)
-            wanted_max_id = min(max_id+1, max_scan_id)
-        elif min_scan_id is not None and max_scan_id is None:
-            wanted_min_id = max(since_id+1, min_scan_id)
-        elif min_scan_id is None and max_scan_id is not None:
-            wanted_max_id = min(max_id+1, max_scan_id)
+        formatter = EdgeFormatter()
+        return stream_json_array(rows, formatter.format_one)
+    else:
+        return flask.make_response('', 404)
 
-        conds = [user_id]
+@app.route('/edges/near/<vtime>/followers', methods=['POST'])
+@app.route('/edges/followers', methods=['POST'], defaults={'vtime': None})
+@timed('page.edges_followers_batch.render')
+@make_json_response
+@temporal
+@immutable_history(history_cache, history_margin, Scan.SCAN_TYPE_FOLLOWERS)
+@timeline()
+@nearest_scan(Scan.SCAN_TYPE_FOLLOWERS)
+@cassandrafied
+@track_pageview
+def timeless_list_followers_batch(cassandra_cluster, vtime, max_id, since_id, since_count, max_scan_id, min_scan_id):
+    user_ids = []
+    for user_id in flask.request.values.getlist('users'):
+        if user_id not in user_ids:
+            user_ids.append(user_id)
 
-        id_condition = 'id >= %s'
-        conds.append(wanted_min_id)
+    if not len(user_ids) or len(user_ids) > BATCH_MAX_USERS:
+        return flask.make_response('', 400)
 
-        if wanted_max_id != float('+inf'):
-            id_condition += ' and id < %s'
-            conds.append(wanted_max_id)
+    valid_users = set()
+    for user in beta_predicate_users(TwitterUser.query.filter(TwitterUser.twitter_id.in_(user_ids))).all():
+        valid_users.add(str(user.twitter_id))
 
-        rows = cassandra_cluster.execute("SELECT id, to_user, from_user, \"timestamp\" FROM tuser_tuser WHERE to_user = %s AND " + id_condition + " ORDER BY id DESC LIMIT " + str(since_count), tuple(conds))
+    (wanted_min_id, wanted_max_id) = followers_window(since_id, max_id, min_scan_id, max_scan_id)
+    wanted_user_ids = [user_id for user_id in user_ids if user_id in valid_users]
+    snapshot = follower_graphs.get(min_scan_id, max_scan_id)
+
+    def generate():
         formatter = EdgeFormatter()
-        return json.dumps(formatter.format(rows))
-    else:
+        separator = '{'
+
+        for user_id in user_ids:
+            if user_id not in valid_users:
+                yield separator + json.dumps(user_id) + ': null'
+                separator = ', '
+
+        if snapshot is not None:
+            results = ((user_id, snapshot.followers(user_id, wanted_min_id, wanted_max_id, since_count)[0]) for user_id in wanted_user_ids)
+        else:
+            results = fetch_followers_concurrently(cassandra_cluster, cassandra_pool, wanted_user_ids, wanted_min_id, wanted_max_id, since_count)
+
+        for (user_id, rows) in results:
+            if rows is None:
+                yield separator + json.dumps(user_id) + ': null'
+            else:
+                yield separator + json.dumps(user_id) + ': ' + json.dumps(formatter.format(rows))
+            separator = ', '
+
+        if separator == '{':
+            yield '{}'
+        else:
+            yield '}'
+
+    return flask.Response(flask.stream_with_context(generate()))
+
+@app.route('/edges/diff/<from_vtime>/<to_vtime>/followers/<user_id>', methods=['GET'])
+@timed('page.edges_diff.render')
+@make_json_response
+@cassandrafied
+@track_pageview
+def timeless_diff_followers(cassandra_cluster, from_vtime, to_vtime, user_id):
+    user = beta_predicate_users(TwitterUser.query.filter(TwitterUser.twitter_id == user_id)).first()
+
+    if user is None:
         return flask.make_response('', 404)
 
+    def followers_near(vtime):
+        (min_scan_id, max_scan_id) = scan_window(find_nearest_scan(Scan.SCAN_TYPE_FOLLOWERS, clamp_virtual_time(vtime)))
+        snapshot = follower_graphs.get(min_scan_id, max_scan_id)
+
+        if snapshot is not None:
+            return snapshot.edges_to(user_id)
+
+        (wanted_min_id, wanted_max_id) = followers_window(0, float('inf'), min_scan_id, max_scan_id)
+        return iterate_followers(cassandra_cluster, cassandra_pool, user_id, wanted_min_id, wanted_max_id)
+
+    old_edges = followers_near(from_vtime)
+    new_edges = followers_near(to_vtime)
+
+    def generate():
+        formatter = EdgeFormatter()
+        separator = ''
+        removing = False
+
+        yield '{"added": ['
+
+        for (change, edge) in diff_edges(old_edges, new_edges):
+            if change == 'removed' and not removing:
+                yield '], "removed": ['
+                separator = ''
+                removing = True
+
+            yield separator + json.dumps(formatter.format_one(edge))
+            separator = ', '
+
+        if not removing:
+            yield '], "removed": ['
+
+        yield ']}'
+
+    return flask.Response(flask.stream_with_context(generate()))
+
 @app.route('/edges/explore/<vtime>/<from_user>/to/<to_user>', methods=['GET'])
 @timed('page.edges_explore.render')
 @make_json_response
 @temporal
+@immutable_history(history_cache, history_margin, Scan.SCAN_TYPE_FOLLOWERS)
 @timeline()
 @nearest_scan(Scan.SCAN_TYPE_FOLLOWERS)
+@paged
 @cassandrafied
 @track_pageview
-def timeless_explore_edges(cassandra_cluster, vtime, from_user, to_user, max_id, since_id, since_count, max_scan_id, min_scan_id):
+def timeless_explore_edges(cassandra_cluster, vtime, from_user, to_user, max_id, since_id, since_count, max_scan_id, min_scan_id, paging_state):
     to_user = beta_predicate_users(TwitterUser.query.filter(TwitterUser.user_id == to_user)).first()
 
     if to_user is not None:
-        id_condition = ""
-        ids = []
-
-        wanted_min_id = since_id
-        wanted_max_id = max_id+1
-
-        if max_scan_id is not None:
-            wanted_max_id = min(max_id+1, max_scan_id)
-        elif max_scan_id is not None:
-            wanted_max_id = min(max_id+1, max_scan_id)
+        (wanted_min_id, wanted_max_id) = explore_window(since_id, max_id, max_scan_id)
+        snapshot = follower_graphs.get(min_scan_id, max_scan_id)
 
-        conds = [to_user.user_id, from_user]
+        # explore reads every scan up to this one, so a single-scan snapshot only helps when the window starts inside it
+        if snapshot is not None and paging_state is None and snapshot.covers(wanted_min_id+1, wanted_max_id):
+            (rows, flask.g.next_edge_id) = snapshot.edges_between(from_user, to_user.user_id, wanted_min_id, wanted_max_id, since_count)
+        else:
+            (statement, params) = explore_statement(cassandra_pool, to_user.user_id, from_user, wanted_min_id, wanted_max_id)
 
-        id_condition = 'id > %s'
-        conds.append(wanted_min_id)
+            logging.info(params)
 
-        if wanted_max_id != float('+inf'):
-            id_condition += ' and id < %s'
-            conds.append(wanted_max_id)
+            (rows, flask.g.next_paging_state) = fetch_page(cassandra_cluster, statement, params, since_count, paging_state)
 
-        logging.info(id_condition)
-        logging.info(conds)
-
-        rows = cassandra_cluster.execute("SELECT id, to_user, from_user, \"timestamp\" FROM tuser_tuser_inspect WHERE to_user = %s AND from_user = %s AND " + id_condition + " ORDER BY id DESC LIMIT " + str(since_count), tuple(conds))
         formatter = EdgeFormatter()
-        return json.dumps(formatter.format(rows))
+        return stream_json_array(rows, formatter.format_one)
     else:
         return flask.make_response('', 404)
 
 @app.route('/user/near/<vtime>', methods=['GET'])
 @app.route('/user', methods=['GET'], defaults={'vtime': None})
 @timed('page.user_list.render')
+@coalesced
 @make_json_response
 @temporal
+@immutable_history(history_cache, history_margin, Scan.SCAN_TYPE_USER)
 @cursor(1E4)
 @nearest_scan(Scan.SCAN_TYPE_USER)
 @track_pageview
-def list_users(vtime, cursor_size, offset, max_scan_id, min_scan_id):
+def list_users(vtime, cursor_size, offset, after_id, before_id, max_scan_id, min_scan_id):
     users = beta_predicate_observations(TUser.query.filter(
         TUser.id >= min_scan_id,
         TUser.id <= max_scan_id
-    )).order_by(TUser.id.desc()).limit(cursor_size).offset(offset).all()
+    ))
+
+    (first_id, last_id) = keyset_page(users, TUser.id, cursor_size, offset, after_id, before_id)
+
+    if first_id is None:
+        return json.dumps([])
+
+    users = project_users(users.filter(
+        TUser.id <= first_id,
+        TUser.id >= last_id
+    ).order_by(TUser.id.desc()))
     formatter = UserFormatter()
-    return json.dumps(formatter.format(users))
+    return stream_query(users, formatter.row_encoder())
 
 @app.route('/user/near/<vtime>/<user_id>', methods=['GET'])
 @app.route('/user/<user_id>', methods=['GET'], defaults={'vtime': None})
 @timed('page.user_get.render')
+@coalesced
 @make_json_response
 @temporal
+@immutable_history(history_cache, history_margin, Scan.SCAN_TYPE_USER)
 @nearest_scan(Scan.SCAN_TYPE_USER)
 @track_pageview
 def show_user(vtime, user_id, max_scan_id, min_scan_id):
@@ -256,12 +474,12 @@ def show_user(vtime, user_id, max_scan_id, min_scan_id):
 @make_json_response
 @track_pageview
 def count_tweets_by_time(start, end):
-    tweets = beta_predicate_tweets(Tweet.query.filter(
-        Tweet.timestamp >= TIME_BOT_COMPETITION_START,
-        Tweet.timestamp <= translate_alpha_time_to_virtual_time(time.time()),
-        Tweet.timestamp >= translate_alpha_time_to_virtual_time(int(start)),
-        Tweet.timestamp < translate_alpha_time_to_virtual_time(int(end))
-    )).count()
+    tweets = tweet_histogram.count_by_time(
+        (not we_are_out_of_beta()),
+        translate_alpha_time_to_virtual_time(int(start)),
+        translate_alpha_time_to_virtual_time(int(end)),
+        translate_alpha_time_to_virtual_time(time.time())
+    )
 
     return json.dumps({'tweets': tweets})
 
@@ -270,12 +488,12 @@ def count_tweets_by_time(start, end):
 @make_json_response
 @track_pageview
 def count_tweets_by_id(start, end):
-    tweets = beta_predicate_tweets(Tweet.query.filter(
-        Tweet.timestamp >= TIME_BOT_COMPETITION_START,
-        Tweet.timestamp <= translate_alpha_time_to_virtual_time(time.time()),
-        Tweet.tweet_id >= start, 
-        Tweet.tweet_id < end,
-    )).count()
+    tweets = tweet_histogram.count_by_id(
+        (not we_are_out_of_beta()),
+        int(start),
+        int(end),
+        translate_alpha_time_to_virtual_time(time.time())
+    )
 
     return json.dumps({'tweets': tweets})
 
@@ -283,8 +501,10 @@ def count_tweets_by_id(start, end):
 @app.route('/user/near/<vtime>/<user_id>/tweets', methods=['GET'])
 @app.route('/user/<user_id>/tweets', methods=['GET'], defaults={'vtime': None})
 @timed('page.user_tweets.render')
+@coalesced
 @make_json_response
 @temporal
+@immutable_history(history_cache, history_margin)
 @timeline()
 @track_pageview
 def list_tweets_by_user(vtime, max_id, since_id, since_count, user_id):
@@ -294,33 +514,37 @@ def list_tweets_by_user(vtime, max_id, since_id, since_count, user_id):
 
     if user is None:
         return flask.make_response('', 404)
+    elif not is_participant(user_id):
+        return json.dumps([])
     else:
-        tweets = beta_predicate_tweets(Tweet.query.filter(
+        tweets = project_tweets(Tweet.query.filter(
             Tweet.timestamp >= TIME_BOT_COMPETITION_START,
             Tweet.tweet_id > since_id, 
             Tweet.tweet_id <= max_id, 
             Tweet.timestamp <= vtime, 
             Tweet.user_id == user_id
-        )).order_by(Tweet.tweet_id.desc()).limit(since_count).all()
+        ).order_by(Tweet.tweet_id.desc()).limit(since_count))
         formatter = TweetFormatter()
-        return json.dumps(formatter.format(tweets))
+        return stream_query(tweets, formatter.row_encoder())
 
 @app.route('/tweets/near/<vtime>', methods=['GET'])
 @app.route('/tweets', methods=['GET'], defaults={'vtime': None})
 @timed('page.tweets.render')
+@coalesced
 @make_json_response
 @temporal
+@immutable_history(history_cache, history_margin)
 @timeline()
 @track_pageview
 def list_tweets(vtime, max_id, since_id, since_count):
-    tweets = beta_predicate_tweets(Tweet.query.filter(
+    tweets = project_tweets(beta_predicate_tweets(Tweet.query.filter(
         Tweet.timestamp >= TIME_BOT_COMPETITION_START,
         Tweet.tweet_id > since_id, 
         Tweet.tweet_id <= max_id, 
         Tweet.timestamp <= vtime
-    )).order_by(Tweet.tweet_id.desc()).limit(int(since_count)).all()
+    )).order_by(Tweet.tweet_id.desc()).limit(int(since_count)))
     formatter = TweetFormatter()
-    return json.dumps(formatter.format(tweets))
+    return stream_query(tweets, formatter.row_encoder())
 
 @app.route('/search', methods=['GET', 'POST'])
 @timed('page.search.render')
@@ -328,28 +552,47 @@ def list_tweets(vtime, max_id, since_id, since_count):
 @timeline()
 @track_pageview
 def search(max_id, since_id, since_count):
+    now = get_current_virtual_time()
+
     tweets_query = beta_predicate_tweets(Tweet.query.filter(
         Tweet.timestamp >= TIME_BOT_COMPETITION_START,
-        Tweet.timestamp < get_current_virtual_time(), 
+        Tweet.timestamp < now, 
         Tweet.tweet_id > since_id, 
         Tweet.tweet_id <= max_id
     )).order_by(Tweet.tweet_id.desc())
 
+    # X-Debug: any value returns the trace in headers; X-Debug: explain, with the admin passcode only, also runs
+    # EXPLAIN ANALYZE on each query and returns the plans in the body
+    explain = flask.request.headers.get('X-Debug') == 'explain'
+
+    if explain and not ('Authorization' in flask.request.headers and has_admin_passcode()):
+        return flask.make_response('', 403)
+
     debug = []
-    search = Search(flask.request.values['q'], debug)
-    tree = search.parse()
-    ors = search.apply(tweets_query, tree)
+    search = Search(flask.request.values['q'], debug, search_text_backend, explain)
+    tree = search.build_tree(search.parse())
 
     if 'users' in flask.request.values:
         tweet_query.filter(Tweet.user_id.in_(flask.request.values['users']))
 
-    tweets = tweets_query.filter(ors).limit(since_count).all()
+    tweets = search.fetch(tweets_query, tree, entity_index, since_id, max_id, since_count, now)
 
-    formatter = TweetFormatter()
-    resp = json.dumps(formatter.format(tweets))
+    with search.timer.stage('format'):
+        formatted = TweetFormatter().format_rows(tweets)
+
+    with search.timer.stage('encode'):
+        if explain:
+            resp = json.dumps({'tweets': formatted, 'debug': {'steps': debug, 'stages': search.timer.milliseconds(), 'plans': search.plans}})
+        else:
+            resp = json.dumps(formatted)
+
+    search.timer.report('page.search.stage', get_tags(), search_trace_sample_rate)
 
     if 'X-Debug' in flask.request.headers:
-        return flask.make_response(resp, 200, {'Debug': debug})
+        return flask.make_response(resp, 200, {
+            'Debug': json.dumps({'steps': debug, 'stages': search.timer.milliseconds()}),
+            'Server-Timing': search.timer.server_timing()
+        })
     else:
         return resp
 
@@ -377,12 +620,7 @@ def show_guess(team_id, guess_id):
 def list_guesses(team_id):
     guesses = Guess.query.filter(Guess.team_id == team_id).all()
 
-    scores = dict()
-    for guess in guesses:
-        scores[guess.id] = dict()
-
-    for guess in guesses:
-        scores[guess.id] = process_guess_scores(guess)
+    scores = score_guesses(guesses)
 
     formatter = GuessFormatter()
     return json.dumps(formatter.format(guesses, scores))
@@ -400,22 +638,37 @@ def make_guess(team_id):
     if 'bots' not in flask.request.values or not len(bot_guesses):
         return flask.make_response('', 400)
 
-    guess = Guess(team_id=team_id, timestamp=time.time(), beta=(not we_are_out_of_beta()))
-    database.db.session.add(guess)
-    database.db.session.commit()
+    user_ids = []
+    seen = set()
 
     for bot in bot_guesses:
-        guess_user = GuessUser(guess_id=guess.id, tuser_id=bot)
-        database.db.session.add(guess_user)
+        try:
+            user_id = int(bot)
+        except ValueError:
+            return flask.make_response('', 400)
 
-    database.db.session.commit()
+        if user_id not in seen:
+            seen.add(user_id)
+            user_ids.append(user_id)
 
-    guess = Guess.query.filter(Guess.id == guess.id).first()
+    guess = Guess(team_id=team_id, timestamp=int(round(time.time())), beta=(not we_are_out_of_beta()))
+    database.db.session.add(guess)
+    database.db.session.flush()
 
-    scores = process_guess_scores(guess)
+    (guess_id, timestamp) = (guess.id, guess.timestamp)
+
+    # one multi-row insert rather than an ORM object per guessed user
+    database.db.session.execute(GuessUser.__table__.insert(), [{'guess_id': guess_id, 'tuser_id': user_id} for user_id in user_ids])
+
+    scores = score_guessed_users(user_ids)
+
+    if not guess.beta:
+        apply_guess(team_id, guess_id, timestamp, scores)
+
+    database.db.session.commit()
 
     formatter = GuessFormatter()
-    return json.dumps(formatter.format(guess, scores))
+    return json.dumps(formatter.format_guess(guess_id, timestamp, user_ids, scores))
 
 @app.route('/scorecard', methods=['GET'], defaults={'gtime': None})
 @app.route('/scorecard/near/<gtime>', methods=['GET'])
@@ -425,38 +678,30 @@ def make_guess(team_id):
 @track_pageview
 def get_scorecard(team_id, gtime):
     if gtime is None:
-        gtime = round(time.time())
-
-    guesses = Guess.query.filter(Guess.beta == False, Guess.team_id == team_id, Guess.timestamp <= gtime).all()
+        scorecard = read_scorecard(team_id)
 
-    net_score = 0
-    negative_score = 0
-    positive_score = 0
-    scores_by_user = dict() # user -> score; prevent same user counting multiple times
+        if scorecard is not None:
+            return json.dumps(scorecard)
 
-    for guess in guesses:
-        guess_scores = process_guess_scores(guess)
-        for (user, score) in guess_scores.items():
-            if score is not None:
-                scores_by_user[user] = score
+        gtime = round(time.time())
 
-    for (user, score) in scores_by_user.items():
-        net_score += score
-        if score > 0:
-            positive_score += score
-        elif score < 0:
-            negative_score += score
+    return json.dumps(get_timeline(team_id).at(float(gtime)))
 
-    (finished, bonus) = get_score_bonus(team_id, guesses)
+@app.route('/scorecard/history', methods=['GET'])
+@timed('page.scorecard_history.render')
+@make_json_response
+@require_passcode
+@track_pageview
+def get_scorecard_history(team_id):
+    return json.dumps(get_timeline(team_id).series())
 
-    return json.dumps({
-        'score_subtotal': net_score,
-        'score_total': net_score + bonus,
-        'finished': finished,
-        'bonus': bonus,
-        'negative_score': negative_score,
-        'positive_score': positive_score
-    })
+@app.route('/leaderboard', methods=['GET'])
+@timed('page.leaderboard.render')
+@make_json_response
+@require_admin_passcode
+@track_pageview
+def get_leaderboard_standings():
+    return json.dumps(get_leaderboard())
 
 syslog = SysLogHandler('/dev/log', SysLogHandler.LOG_DAEMON, socket.SOCK_STREAM)
 syslog.setLevel(logging.DEBUG)
@@ -0,0 +1,157 @@
+import sys
+import time
+import random
+import json
+import database
+
+from flask import Flask
+from ConfigParser import ConfigParser
+
+from sqlalchemy import column
+from sqlalchemy import select
+from sqlalchemy import table
+from sqlalchemy import text
+
+from tweet import Tweet
+from formatter import TweetFormatter
+from projection import project_tweets
+from util import TIME_BOT_COMPETITION_START
+from util import GENEROUS_CURSOR_UPPER_BOUND
+from search import Search
+from search import parse_cache
+from text_index import text_predicate
+from text_index import TEXT_BACKEND_SUBSTRING
+from text_index import TEXT_BACKEND_FULLTEXT
+from text_index import TEXT_SEARCH_CONFIG
+
+SEARCH_QUERIES = [
+    '#botornot',
+    'url:http://example.com/a/long/path?with=query',
+    'pacsocial bots',
+    '#one #two #three url:http://t.co/x some plain words here',
+    ' '.join(['word%d' % (i,) for i in range(200)])
+]
+
+def measure(f, iterations):
+    start = time.time()
+    for i in range(iterations):
+        f()
+    return (time.time() - start) / iterations
+
+def benchmark_search(iterations):
+    # queries without mentions, so parse never touches the database
+    for query in SEARCH_QUERIES:
+        def cold():
+            parse_cache.clear()
+            Search(query, []).parse()
+
+        def warm():
+            Search(query, []).parse()
+
+        print('%-60s cold %8.1fus  warm %8.1fus' % (query[:60], measure(cold, iterations) * 1e6, measure(warm, iterations) * 1e6))
+
+def make_app():
+    config = ConfigParser()
+    config.read('configuration.ini')
+
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'postgresql://%s:%s@/pacsocial?host=%s' % (config.get('postgresql', 'username'), config.get('postgresql', 'password'), config.get('postgresql', 'socket'))
+    app.config['SQLALCHEMY_ECHO'] = False
+    database.db.init_app(app)
+
+    return app
+
+TEXT_CORPUS_SIZE = 200000
+TEXT_VOCABULARY_SIZE = 20000
+TEXT_WORDS_PER_TWEET = 12
+TEXT_PAGE_SIZE = 50
+
+def synthetic_tweets(count):
+    # zipf-ish word frequencies, so some terms match most tweets and some almost none
+    generator = random.Random(0)
+    vocabulary = [''.join(generator.choice('abcdefghijklmnopqrstuvwxyz') for j in range(generator.randint(3, 10))) for i in range(TEXT_VOCABULARY_SIZE)]
+
+    for i in range(count):
+        words = [vocabulary[min(int(generator.paretovariate(1.0)) - 1, TEXT_VOCABULARY_SIZE - 1)] for j in range(TEXT_WORDS_PER_TWEET)]
+        yield ' '.join(words)[:256]
+
+    # the terms benchmarked: a common word, a rare word and a fragment of a word, which only substring matches
+    yield vocabulary[0]
+    yield vocabulary[TEXT_VOCABULARY_SIZE // 2]
+    yield [word for word in vocabulary[1:] if len(word) >= 6][0][1:-1]
+
+def benchmark_text(iterations):
+    # times the SQL each text backend generates against a synthetic corpus in a temporary copy of the tweet table;
+    # run create_text_indexes.py first so pg_trgm is installed
+    tweets = list(synthetic_tweets(TEXT_CORPUS_SIZE))
+    terms = tweets[-3:]
+    tweets = tweets[:-3]
+
+    corpus = table('benchmark_tweet', column('id'), column('text'))
+
+    with make_app().app_context():
+        connection = database.db.engine.connect()
+
+        connection.execute(text('CREATE TEMPORARY TABLE benchmark_tweet (id serial PRIMARY KEY, text varchar(256))'))
+        for start in range(0, len(tweets), 10000):
+            connection.execute(corpus.insert(), [{'text': tweet} for tweet in tweets[start:start+10000]])
+
+        variants = [
+            ('substring, no index', TEXT_BACKEND_SUBSTRING, None),
+            ('substring, trigram index', TEXT_BACKEND_SUBSTRING, 'CREATE INDEX ON benchmark_tweet USING gin (text gin_trgm_ops)'),
+            ('fulltext, tsvector index', TEXT_BACKEND_FULLTEXT, "CREATE INDEX ON benchmark_tweet USING gin (to_tsvector('%s'::regconfig, text))" % (TEXT_SEARCH_CONFIG,))
+        ]
+
+        for (name, backend, index) in variants:
+            if index is not None:
+                connection.execute(text(index))
+            connection.execute(text('ANALYZE benchmark_tweet'))
+
+            for term in terms:
+                predicate = text_predicate(corpus.c.text, term, backend)
+                page = select([corpus.c.id]).where(predicate).order_by(corpus.c.id.desc()).limit(TEXT_PAGE_SIZE)
+                matches = connection.execute(select([text('count(*)')]).select_from(corpus).where(predicate)).scalar()
+
+                elapsed = measure(lambda: connection.execute(page).fetchall(), iterations)
+
+                print('%-26s %-12s %7d matches %9.2fms' % (name, term, matches, elapsed * 1e3))
+
+        connection.close()
+
+def benchmark_formatter(iterations):
+    # the /tweets query at the largest page size through to the encoded body, loading Tweet objects vs projected rows
+    with make_app().app_context():
+        query = Tweet.query.filter(Tweet.timestamp >= TIME_BOT_COMPETITION_START).order_by(Tweet.tweet_id.desc()).limit(GENEROUS_CURSOR_UPPER_BOUND)
+
+        def orm():
+            body = json.dumps(TweetFormatter().format(query.all()))
+            database.db.session.remove()
+            return body
+
+        def projected():
+            body = json.dumps(TweetFormatter().format_rows(project_tweets(query).all()))
+            database.db.session.remove()
+            return body
+
+        print('identical output: %s' % (json.loads(orm()) == json.loads(projected()),))
+        print('orm       %9.1fms' % (measure(orm, iterations) * 1e3,))
+        print('projected %9.1fms' % (measure(projected, iterations) * 1e3,))
+
+BENCHMARKS = {
+    'formatter': benchmark_formatter,
+    'search': benchmark_search,
+    'text': benchmark_text
+}
+
+# usage: benchmark.py <benchmark> [iterations]
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] not in BENCHMARKS:
+        print('usage: benchmark.py <%s> [iterations]' % ('|'.join(sorted(BENCHMARKS.keys())),))
+        sys.exit(1)
+
+    if len(sys.argv) > 2:
+        iterations = int(sys.argv[2])
+    else:
+        iterations = 1000
+
+    BENCHMARKS[sys.argv[1]](iterations)
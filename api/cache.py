@@ -0,0 +1,54 @@
+import threading
+import time
+
+from collections import OrderedDict
+
+class LRUCache:
+    # Bounded, thread-safe, least recently used mapping; entries optionally expire ttl seconds after being set.
+    def __init__(self, maxsize, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = OrderedDict() # key -> (expires, value)
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+
+            if entry is None:
+                return default
+
+            (expires, value) = entry
+
+            if expires is not None and expires <= time.time():
+                return default
+
+            self.entries[key] = entry
+            return value
+
+    def set(self, key, value, ttl=None):
+        if ttl is None:
+            ttl = self.ttl
+
+        if ttl is None:
+            expires = None
+        else:
+            expires = time.time() + ttl
+
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (expires, value)
+
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
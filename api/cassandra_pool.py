@@ -0,0 +1,125 @@
+import atexit
+import logging
+import os
+import threading
+
+from cassandra.cluster import Cluster
+from cassandra.auth import PlainTextAuthProvider
+from cassandra.policies import DCAwareRoundRobinPolicy
+from cassandra.policies import TokenAwarePolicy
+
+class CassandraSessionPool:
+    def __init__(self, contact_points, keyspace, username, password, executor_threads=8, local_dc=None):
+        self.contact_points = contact_points
+        self.keyspace = keyspace
+        self.username = username
+        self.password = password
+        self.executor_threads = executor_threads
+        self.local_dc = local_dc
+
+        self.statements = dict() # name -> cql
+        self.prepared = dict() # name -> PreparedStatement for the current session
+
+        self.lock = threading.Lock()
+        self.pid = None
+        self.cluster = None
+        self.session = None
+
+        atexit.register(self.shutdown)
+
+    def _connect(self):
+        cluster = Cluster(
+            self.contact_points,
+            auth_provider=PlainTextAuthProvider(username=self.username, password=self.password),
+            # prepared statements carry their routing key, so token awareness sends each query straight to a replica
+            load_balancing_policy=TokenAwarePolicy(DCAwareRoundRobinPolicy(local_dc=self.local_dc)),
+            executor_threads=self.executor_threads
+        )
+
+        try:
+            session = cluster.connect(self.keyspace)
+        except:
+            cluster.shutdown()
+            raise
+
+        logging.info('connected to cassandra from pid %d', os.getpid())
+
+        return (cluster, session)
+
+    def _is_healthy(self):
+        if self.pid != os.getpid():
+            # A forked worker inherits the parent's sockets but none of the driver's threads,
+            # so the inherited cluster is unusable; just forget about it.
+            return False
+
+        if self.session is None or self.session.is_shutdown or self.cluster.is_shutdown:
+            return False
+
+        for host in self.cluster.metadata.all_hosts():
+            if host.is_up:
+                return True
+
+        return False
+
+    def get_session(self):
+        if self._is_healthy():
+            return self.session
+
+        with self.lock:
+            if not self._is_healthy():
+                if self.pid == os.getpid():
+                    self._shutdown()
+                else:
+                    self.cluster = None
+                    self.session = None
+
+                (self.cluster, self.session) = self._connect()
+                self.prepared = dict()
+                self.pid = os.getpid()
+
+            return self.session
+
+    def register_statement(self, name, cql):
+        self.statements[name] = cql
+
+    def get_prepared(self, name):
+        session = self.get_session()
+
+        statement = self.prepared.get(name)
+        if statement is not None:
+            return statement
+
+        with self.lock:
+            # statements belong to the session they were prepared on; a reconnect empties the registry
+            if self.session is not session:
+                return session.prepare(self.statements[name])
+
+            if name not in self.prepared:
+                self.prepared[name] = session.prepare(self.statements[name])
+
+            return self.prepared[name]
+
+    def invalidate(self):
+        with self.lock:
+            if self.pid == os.getpid():
+                self._shutdown()
+
+    def _shutdown(self):
+        cluster = self.cluster
+        session = self.session
+
+        self.cluster = None
+        self.session = None
+        self.prepared = dict()
+
+        try:
+            if session is not None:
+                session.shutdown()
+            if cluster is not None:
+                cluster.shutdown()
+        except Exception:
+            logging.exception('error shutting down cassandra cluster')
+
+    def shutdown(self):
+        if self.pid == os.getpid():
+            self._shutdown()
@@ -0,0 +1,40 @@
+import database
+import logging
+
+from flask import Flask
+from ConfigParser import ConfigParser
+
+from sqlalchemy import text
+
+from text_index import TEXT_EXTENSION_DDL
+from text_index import TEXT_INDEXES
+
+config = ConfigParser()
+config.read('configuration.ini')
+
+app = Flask(__name__)
+app.config['SQLALCHEMY_DATABASE_URI'] = 'postgresql://%s:%s@/pacsocial?host=%s' % (config.get('postgresql', 'username'), config.get('postgresql', 'password'), config.get('postgresql', 'socket'))
+app.config['SQLALCHEMY_ECHO'] = False
+database.db.init_app(app)
+
+# usage: create_text_indexes.py
+# builds the indexes behind both text backends without locking the tweet table against writes
+if __name__ == "__main__":
+    logging.getLogger().setLevel(logging.INFO)
+
+    with app.app_context():
+        # CREATE INDEX CONCURRENTLY refuses to run inside a transaction
+        connection = database.db.engine.connect().execution_options(isolation_level='AUTOCOMMIT')
+
+        logging.info(TEXT_EXTENSION_DDL)
+        connection.execute(text(TEXT_EXTENSION_DDL))
+
+        for (name, statement) in TEXT_INDEXES:
+            if connection.execute(text('SELECT 1 FROM pg_indexes WHERE indexname = :name'), name=name).first() is not None:
+                logging.info('index %s already exists', name)
+                continue
+
+            logging.info(statement)
+            connection.execute(text(statement))
+
+        connection.close()
@@ -0,0 +1,132 @@
+import logging
+
+from cassandra import InvalidRequest
+from cassandra.concurrent import execute_concurrent
+from cassandra.protocol import ProtocolException
+
+BATCH_MAX_USERS = 1000
+BATCH_CONCURRENCY = 32
+SCAN_FETCH_SIZE = 5000
+
+STATEMENT_FOLLOWERS = 'followers'
+STATEMENT_FOLLOWERS_BOUNDED = 'followers_bounded'
+STATEMENT_EXPLORE = 'explore'
+STATEMENT_EXPLORE_BOUNDED = 'explore_bounded'
+STATEMENT_SNAPSHOT = 'snapshot'
+
+STATEMENTS = {
+    STATEMENT_FOLLOWERS: 'SELECT id, to_user, from_user, "timestamp" FROM tuser_tuser WHERE to_user = ? AND id >= ? ORDER BY id DESC',
+    STATEMENT_FOLLOWERS_BOUNDED: 'SELECT id, to_user, from_user, "timestamp" FROM tuser_tuser WHERE to_user = ? AND id >= ? AND id < ? ORDER BY id DESC',
+    STATEMENT_EXPLORE: 'SELECT id, to_user, from_user, "timestamp" FROM tuser_tuser_inspect WHERE to_user = ? AND from_user = ? AND id > ? ORDER BY id DESC',
+    STATEMENT_EXPLORE_BOUNDED: 'SELECT id, to_user, from_user, "timestamp" FROM tuser_tuser_inspect WHERE to_user = ? AND from_user = ? AND id > ? AND id < ? ORDER BY id DESC',
+    # whole-scan read for the in-memory follower graph; only ever run by the background loader
+    STATEMENT_SNAPSHOT: 'SELECT id, to_user, from_user, "timestamp" FROM tuser_tuser WHERE id >= ? AND id < ? ALLOW FILTERING'
+}
+
+class InvalidPagingState(Exception):
+    pass
+
+def register_edge_statements(pool):
+    for (name, cql) in STATEMENTS.items():
+        pool.register_statement(name, cql)
+
+def followers_window(since_id, max_id, min_scan_id, max_scan_id):
+    # [wanted_min_id, wanted_max_id) of tuser_tuser ids to read for one followers_wide scan
+    wanted_min_id = since_id+1
+    wanted_max_id = max_id+1
+
+    if min_scan_id is not None:
+        wanted_min_id = max(since_id+1, min_scan_id)
+
+    if max_scan_id is not None:
+        wanted_max_id = min(max_id+1, max_scan_id)
+
+    return (wanted_min_id, wanted_max_id)
+
+def explore_window(since_id, max_id, max_scan_id):
+    # (wanted_min_id, wanted_max_id) exclusive on both ends, for tuser_tuser_inspect
+    wanted_min_id = since_id
+    wanted_max_id = max_id+1
+
+    if max_scan_id is not None:
+        wanted_max_id = min(max_id+1, max_scan_id)
+
+    return (wanted_min_id, wanted_max_id)
+
+def followers_statement(pool, user_id, wanted_min_id, wanted_max_id):
+    if wanted_max_id != float('+inf'):
+        return (pool.get_prepared(STATEMENT_FOLLOWERS_BOUNDED), (user_id, wanted_min_id, wanted_max_id))
+    else:
+        return (pool.get_prepared(STATEMENT_FOLLOWERS), (user_id, wanted_min_id))
+
+def explore_statement(pool, to_user, from_user, wanted_min_id, wanted_max_id):
+    if wanted_max_id != float('+inf'):
+        return (pool.get_prepared(STATEMENT_EXPLORE_BOUNDED), (to_user, from_user, wanted_min_id, wanted_max_id))
+    else:
+        return (pool.get_prepared(STATEMENT_EXPLORE), (to_user, from_user, wanted_min_id))
+
+def fetch_page(session, statement, params, fetch_size, paging_state=None):
+    # The page size takes the place of a LIMIT: the first page is exactly what LIMIT fetch_size used to return,
+    # and the paging state lets the caller carry on from there without re-reading the partition.
+    bound = statement.bind(params)
+    bound.fetch_size = int(fetch_size)
+
+    try:
+        results = session.execute(bound, paging_state=paging_state)
+    except (InvalidRequest, ProtocolException):
+        # a paging state the server can't resume from is the client's mistake; anything else is ours
+        if paging_state is None:
+            raise
+        raise InvalidPagingState()
+
+    if results.has_more_pages:
+        return (results.current_rows, results.paging_state)
+    else:
+        return (results.current_rows, None)
+
+def fetch_followers_concurrently(session, pool, user_ids, wanted_min_id, wanted_max_id, fetch_size):
+    # yields (user_id, rows) in the order given, rows is None when that user's query failed
+    statements = []
+
+    for user_id in user_ids:
+        (statement, params) = followers_statement(pool, user_id, wanted_min_id, wanted_max_id)
+        bound = statement.bind(params)
+        bound.fetch_size = int(fetch_size)
+        statements.append((bound, None))
+
+    results = execute_concurrent(session, statements, concurrency=BATCH_CONCURRENCY, raise_on_first_error=False, results_generator=True)
+
+    for (user_id, (success, result)) in zip(user_ids, results):
+        if success:
+            yield (user_id, result.current_rows)
+        else:
+            logging.warn('follower query for %s failed: %s', user_id, result)
+            yield (user_id, None)
+
+def iterate_followers(session, pool, user_id, wanted_min_id, wanted_max_id):
+    # every edge in the window, one page of SCAN_FETCH_SIZE in memory at a time
+    if wanted_min_id >= wanted_max_id:
+        return []
+
+    (statement, params) = followers_statement(pool, user_id, wanted_min_id, wanted_max_id)
+    bound = statement.bind(params)
+    bound.fetch_size = SCAN_FETCH_SIZE
+
+    return session.execute(bound)
+
+def diff_edges(old_edges, new_edges):
+    # Edge ids are per-scan observation ids, so two scans can only be matched on from_user. The older scan is
+    # held as from_user -> edge, the newer one streams past it; yields ('added', edge) then ('removed', edge).
+    remaining = dict()
+
+    for edge in old_edges:
+        remaining[edge.from_user] = edge
+
+    for edge in new_edges:
+        if edge.from_user in remaining:
+            del remaining[edge.from_user]
+        else:
+            yield ('added', edge)
+
+    for edge in sorted(remaining.values(), key=lambda edge: edge.id, reverse=True):
+        yield ('removed', edge)
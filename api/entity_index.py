@@ -0,0 +1,316 @@
+import array
+import bisect
+import logging
+import os
+import threading
+import time
+
+from database import db
+from tweet import Tweet
+from tweet_entity import TweetEntity
+from watermark import CommitWatermark
+
+from util import we_are_out_of_beta
+
+LOAD_CHUNK_SIZE = 50000
+
+# virtual seconds per bucket of the tweet id ceilings
+CEILING_BUCKET_SECONDS = 60
+
+def gallop(values, target, lo, hi):
+    # last i in [lo, hi) with values[i] <= target, or lo - 1; probes hi-1, hi-2, hi-4, hi-8, ... before bisecting,
+    # so walking a long list down in step with a short one costs O(log gap) per step instead of O(gap)
+    step = 1
+    top = hi
+    probe = hi - 1
+
+    while probe >= lo and values[probe] > target:
+        top = probe
+        probe = top - step
+        step *= 2
+
+    return bisect.bisect_right(values, target, max(probe, lo), top) - 1
+
+class Postings:
+    # values[lo:hi] walked from the top down; current() is None once the walk runs off the bottom
+    def __init__(self, values, lo, hi):
+        self.values = values
+        self.lo = lo
+        self.i = hi - 1
+
+    def current(self):
+        if self.i < self.lo:
+            return None
+
+        return self.values[self.i]
+
+    def advance(self):
+        self.i -= 1
+
+    def seek(self, target):
+        # down to the largest id <= target
+        if self.i >= self.lo and self.values[self.i] > target:
+            self.i = gallop(self.values, target, self.lo, self.i)
+
+class Union:
+    # ids in any of cursors, newest first, each once
+    def __init__(self, cursors):
+        self.cursors = cursors
+        self._settle()
+
+    def _settle(self):
+        values = [cursor.current() for cursor in self.cursors if cursor.current() is not None]
+
+        if len(values):
+            self.value = max(values)
+        else:
+            self.value = None
+
+    def current(self):
+        return self.value
+
+    def advance(self):
+        for cursor in self.cursors:
+            if cursor.current() == self.value:
+                cursor.advance()
+
+        self._settle()
+
+    def seek(self, target):
+        for cursor in self.cursors:
+            cursor.seek(target)
+
+        self._settle()
+
+class Intersection:
+    # ids in every one of cursors, newest first; each cursor seeks down to the lowest of the others' current ids
+    def __init__(self, cursors):
+        self.cursors = cursors
+        self._settle()
+
+    def _settle(self):
+        while True:
+            values = [cursor.current() for cursor in self.cursors]
+
+            if None in values:
+                self.value = None
+                return
+
+            low = min(values)
+
+            if max(values) == low:
+                self.value = low
+                return
+
+            for cursor in self.cursors:
+                cursor.seek(low)
+
+    def current(self):
+        return self.value
+
+    def advance(self):
+        self.cursors[0].advance()
+        self._settle()
+
+    def seek(self, target):
+        for cursor in self.cursors:
+            cursor.seek(target)
+
+        self._settle()
+
+def take(cursor, count):
+    # up to count ids from cursor, newest first, moving it past them
+    rv = []
+
+    while len(rv) < count:
+        value = cursor.current()
+
+        if value is None:
+            break
+
+        rv.append(value)
+        cursor.advance()
+
+    return rv
+
+class EntityPostings:
+    # One load of the index for a beta flag and its participant set: (entity type, text) -> ascending ids of the
+    # participant tweets carrying that entity, and per bucket of virtual time the highest of those ids. Extended
+    # in place with entity rows above the highest entity id read, up to the commit watermark so a row that commits
+    # after a higher id never falls behind it.
+    def __init__(self, participant_set, beta, participants):
+        self.participant_set = participant_set
+        self.beta = beta
+        self.participants = participants
+
+        self.postings = dict()
+        self.watermark = CommitWatermark(TweetEntity.id)
+        self.last_entity_id = 0
+        self.max_tweet_id = 0
+        self.latest = dict() # time bucket -> highest tweet id with a timestamp in it
+        self.ceilings = ([], []) # (time buckets in order, highest tweet id in that bucket or any before it)
+
+    def covered_tweet_id(self):
+        # tweets above this id may have entities these postings haven't seen
+        return self.max_tweet_id
+
+    def tweet_id_ceiling(self, now):
+        # no tweet in the postings with a timestamp before now has a higher id; None if none is before now
+        (buckets, running_max) = self.ceilings
+        i = bisect.bisect_right(buckets, int(now) // CEILING_BUCKET_SECONDS)
+
+        if i == 0:
+            return None
+
+        return running_max[i-1]
+
+    def window(self, entity_type, text, since_id, max_id):
+        # cursor over the tweet ids in (since_id, max_id] with the entity, newest first
+        postings = self.postings.get((entity_type, text), ())
+
+        return Postings(postings, bisect.bisect_right(postings, since_id), bisect.bisect_right(postings, max_id))
+
+    def refresh(self):
+        settled = self.watermark.advance()
+        max_tweet_id = self.max_tweet_id
+        backfill = dict() # key -> tweet ids below the end of its postings, merged in once the refresh has read them all
+        added = 0
+
+        while True:
+            rows = db.session.query(TweetEntity.id, TweetEntity.tweet_id, TweetEntity.type, TweetEntity.text, Tweet.timestamp).join(
+                Tweet, Tweet.tweet_id == TweetEntity.tweet_id
+            ).filter(
+                self.participant_set.predicate(self.beta, Tweet.user_id),
+                TweetEntity.id > self.last_entity_id,
+                TweetEntity.id <= settled
+            ).order_by(TweetEntity.id).limit(LOAD_CHUNK_SIZE).all()
+
+            for (entity_id, tweet_id, entity_type, text, timestamp) in rows:
+                self._add(entity_type, text, int(tweet_id), timestamp, backfill)
+                max_tweet_id = max(max_tweet_id, int(tweet_id))
+
+            added += len(rows)
+
+            if len(rows) < LOAD_CHUNK_SIZE:
+                # every entity row up to the watermark has been read, including the non-participant ones skipped
+                self.last_entity_id = max(self.last_entity_id, settled)
+                break
+
+            self.last_entity_id = rows[-1][0]
+
+        # the ceilings go up before the covered id does, so a search never walks below a covered tweet it can see
+        if added:
+            self._merge(backfill)
+            self._rebuild_ceilings()
+            self.max_tweet_id = max_tweet_id
+
+        return added
+
+    def _add(self, entity_type, text, tweet_id, timestamp, backfill):
+        key = (entity_type, text)
+        postings = self.postings.get(key)
+
+        if postings is None:
+            postings = array.array('l')
+            self.postings[key] = postings
+
+        # entities mostly arrive in tweet id order, so appending is the common case; a backfilled tweet waits
+        if not len(postings) or postings[-1] < tweet_id:
+            postings.append(tweet_id)
+        else:
+            backfill.setdefault(key, []).append(tweet_id)
+
+        if timestamp is not None:
+            bucket = int(timestamp) // CEILING_BUCKET_SECONDS
+            self.latest[bucket] = max(self.latest.get(bucket, tweet_id), tweet_id)
+
+    def _merge(self, backfill):
+        # one new copy of each backfilled key rather than one per tweet, since a search walking the old copy below
+        # its end must not see it shift
+        for (key, tweet_ids) in backfill.items():
+            self.postings[key] = array.array('l', sorted(set(self.postings[key]).union(tweet_ids)))
+
+    def _rebuild_ceilings(self):
+        buckets = sorted(self.latest.keys())
+        running_max = []
+
+        for bucket in buckets:
+            running_max.append(max(running_max[-1] if len(running_max) else self.latest[bucket], self.latest[bucket]))
+
+        self.ceilings = (buckets, running_max)
+
+class EntityIndex:
+    # Entity postings of the participant tweets for the current beta flag, loaded and then kept up to date by a
+    # daemon thread. A new beta flag or participant set is loaded in full alongside the old postings, which are
+    # not used for searches meanwhile since they would miss the new participants' tweets.
+    def __init__(self, app, participant_set, poll_interval=10):
+        self.app = app
+        self.participant_set = participant_set
+        self.poll_interval = poll_interval
+
+        self.loaded = None
+        self.lock = threading.Lock()
+        self.pid = None
+        self.thread = None
+
+    def current(self):
+        # the postings if they were loaded for the current beta flag and participant set, else None
+        self._ensure_loader()
+
+        loaded = self.loaded
+        beta = not we_are_out_of_beta()
+
+        if loaded is None or loaded.beta != beta:
+            return None
+
+        self.participant_set.get(beta)
+
+        if loaded.participants != self.participant_set.ordered[beta]:
+            return None
+
+        return loaded
+
+    def _ensure_loader(self):
+        if self.pid == os.getpid() and self.thread is not None and self.thread.is_alive():
+            return
+
+        with self.lock:
+            if self.pid != os.getpid() or self.thread is None or not self.thread.is_alive():
+                if self.pid != os.getpid():
+                    # postings are private to the process that loaded them
+                    self.loaded = None
+
+                self.pid = os.getpid()
+                self.thread = threading.Thread(target=self._run, name='entity-index-loader')
+                self.thread.daemon = True
+                self.thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                with self.app.app_context():
+                    self.refresh()
+            except Exception:
+                logging.exception('entity index refresh failed')
+
+            time.sleep(self.poll_interval)
+
+    def refresh(self):
+        start = time.time()
+
+        try:
+            beta = not we_are_out_of_beta()
+            self.participant_set.get(beta)
+            participants = self.participant_set.ordered[beta]
+
+            postings = self.loaded
+            if postings is None or postings.beta != beta or postings.participants != participants:
+                postings = EntityPostings(self.participant_set, beta, participants)
+
+            added = postings.refresh()
+        finally:
+            db.session.remove()
+
+        if postings is not self.loaded:
+            logging.info('loaded entity index: %d entities, %d keys in %.1fs', added, len(postings.postings), time.time() - start)
+            self.loaded = postings
@@ -0,0 +1,305 @@
+import array
+import bisect
+import logging
+import os
+import threading
+import time
+
+from collections import namedtuple
+from datetime import datetime
+from datetime import timedelta
+
+from scan import Scan
+from database import db
+
+Edge = namedtuple('Edge', ['id', 'to_user', 'from_user', 'timestamp'])
+
+NO_TIMESTAMP = -1
+
+EPOCH = datetime(1970, 1, 1)
+
+def datetime_to_milliseconds(value):
+    delta = value - EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1000 + delta.microseconds // 1000
+
+def milliseconds_to_datetime(value):
+    return EPOCH + timedelta(milliseconds=value)
+
+class ColumnTypes:
+    # the Python types a snapshot's rows came back from the driver with, so edges served from the snapshot are the
+    # same as edges read from Cassandra; CQL timestamps are naive UTC datetimes, stored as epoch milliseconds
+    def __init__(self):
+        self.id = int
+        self.to_user = str
+        self.from_user = str
+        self.timestamp = None
+        self.observed = False
+
+    def observe(self, row):
+        if not self.observed:
+            (self.id, self.to_user, self.from_user) = (type(row.id), type(row.to_user), type(row.from_user))
+            self.observed = True
+
+        if self.timestamp is None and row.timestamp is not None:
+            self.timestamp = type(row.timestamp)
+
+    def encode_timestamp(self, value):
+        if value is None:
+            return NO_TIMESTAMP
+        elif isinstance(value, datetime):
+            return datetime_to_milliseconds(value)
+        else:
+            return int(value)
+
+    def decode_timestamp(self, value):
+        if value == NO_TIMESTAMP:
+            return None
+        elif self.timestamp is datetime:
+            return milliseconds_to_datetime(value)
+        else:
+            return self.timestamp(value)
+
+class UserInterner:
+    # twitter id string <-> dense int for one snapshot, dropped along with it
+    def __init__(self):
+        self.ids = dict()
+        self.names = []
+        self.lock = threading.Lock()
+
+    def intern(self, name):
+        index = self.ids.get(name)
+
+        if index is None:
+            with self.lock:
+                index = self.ids.get(name)
+                if index is None:
+                    index = len(self.names)
+                    self.names.append(name)
+                    self.ids[name] = index
+
+        return index
+
+    def lookup(self, name):
+        return self.ids.get(name)
+
+    def name(self, index):
+        return self.names[index]
+
+class FollowerGraphSnapshot:
+    # Compressed sparse rows over one followers_wide scan: the edges pointing at interned user u are
+    # edge_ids[offsets[u]:offsets[u+1]], sorted by ascending id, with parallel neighbours/timestamps.
+    def __init__(self, scan_id, min_id, max_id, interner, types, offsets, edge_ids, neighbours, timestamps):
+        self.scan_id = scan_id
+        self.min_id = min_id
+        self.max_id = max_id
+        self.interner = interner
+        self.types = types
+        self.offsets = offsets
+        self.edge_ids = edge_ids
+        self.neighbours = neighbours
+        self.timestamps = timestamps
+
+    @classmethod
+    def build(cls, scan_id, min_id, max_id, rows):
+        # One streaming pass into flat arrays, then a counting sort by to_user into the CSR arrays and a sort by id
+        # within each user, so the edges are never held as Python objects.
+        interner = UserInterner()
+        types = ColumnTypes()
+
+        to_users = array.array('l')
+        row_edge_ids = array.array('l')
+        row_neighbours = array.array('l')
+        row_timestamps = array.array('l')
+
+        for row in rows:
+            types.observe(row)
+
+            to_users.append(interner.intern(str(row.to_user)))
+            row_edge_ids.append(int(row.id))
+            row_neighbours.append(interner.intern(str(row.from_user)))
+            row_timestamps.append(types.encode_timestamp(row.timestamp))
+
+        user_count = len(interner.names)
+        edge_count = len(to_users)
+
+        offsets = array.array('l', [0]) * (user_count + 1)
+
+        for user in to_users:
+            offsets[user+1] += 1
+
+        for user in range(user_count):
+            offsets[user+1] += offsets[user]
+
+        positions = array.array('l', offsets)
+        edge_ids = array.array('l', [0]) * edge_count
+        neighbours = array.array('l', [0]) * edge_count
+        timestamps = array.array('l', [0]) * edge_count
+
+        for i in range(edge_count):
+            user = to_users[i]
+            position = positions[user]
+            positions[user] = position + 1
+
+            edge_ids[position] = row_edge_ids[i]
+            neighbours[position] = row_neighbours[i]
+            timestamps[position] = row_timestamps[i]
+
+        del to_users, row_edge_ids, row_neighbours, row_timestamps, positions
+
+        for user in range(user_count):
+            (lo, hi) = (offsets[user], offsets[user+1])
+
+            if hi - lo > 1:
+                order = sorted(range(lo, hi), key=edge_ids.__getitem__)
+
+                for column in (edge_ids, neighbours, timestamps):
+                    column[lo:hi] = array.array('l', [column[i] for i in order])
+
+        return cls(scan_id, min_id, max_id, interner, types, offsets, edge_ids, neighbours, timestamps)
+
+    def __len__(self):
+        return len(self.edge_ids)
+
+    def _range(self, user_id):
+        user = self.interner.lookup(str(user_id))
+
+        if user is None or user + 1 >= len(self.offsets):
+            return (0, 0)
+
+        return (self.offsets[user], self.offsets[user+1])
+
+    def _edge(self, i, to_user):
+        return Edge(
+            self.types.id(self.edge_ids[i]),
+            self.types.to_user(to_user),
+            self.types.from_user(self.interner.name(self.neighbours[i])),
+            self.types.decode_timestamp(self.timestamps[i])
+        )
+
+    def covers(self, wanted_min_id, wanted_max_id):
+        return wanted_min_id >= self.min_id and wanted_max_id <= self.max_id
+
+    def followers(self, user_id, wanted_min_id, wanted_max_id, count):
+        # edges with wanted_min_id <= id < wanted_max_id, newest first, plus the id to continue below if the page is full
+        (lo, hi) = self._range(user_id)
+
+        start = bisect.bisect_left(self.edge_ids, wanted_min_id, lo, hi)
+        end = bisect.bisect_left(self.edge_ids, wanted_max_id, lo, hi)
+        first = max(start, end - int(count))
+
+        rows = [self._edge(i, user_id) for i in range(end - 1, first - 1, -1)]
+
+        if first > start:
+            return (rows, self.edge_ids[first])
+        else:
+            return (rows, None)
+
+    def edges_to(self, user_id):
+        (lo, hi) = self._range(user_id)
+
+        for i in range(hi - 1, lo - 1, -1):
+            yield self._edge(i, user_id)
+
+    def edges_between(self, from_user, to_user, wanted_min_id, wanted_max_id, count):
+        # like followers, but only the edges from one user and with both bounds exclusive
+        (lo, hi) = self._range(to_user)
+        neighbour = self.interner.lookup(str(from_user))
+
+        rows = []
+
+        if neighbour is None:
+            return (rows, None)
+
+        start = bisect.bisect_right(self.edge_ids, wanted_min_id, lo, hi)
+        end = bisect.bisect_left(self.edge_ids, wanted_max_id, lo, hi)
+
+        for i in range(end - 1, start - 1, -1):
+            if self.neighbours[i] == neighbour:
+                if len(rows) == int(count):
+                    return (rows, rows[-1].id)
+                rows.append(self._edge(i, to_user))
+
+        return (rows, None)
+
+class FollowerGraphCache:
+    def __init__(self, app, pool, statement, retain=3, poll_interval=60, fetch_size=5000):
+        self.app = app
+        self.pool = pool
+        self.statement = statement
+        self.retain = retain
+        self.poll_interval = poll_interval
+        self.fetch_size = fetch_size
+
+        self.snapshots = dict() # (min_scan_id, max_scan_id) -> FollowerGraphSnapshot
+        self.lock = threading.Lock()
+        self.pid = None
+        self.thread = None
+
+    def get(self, min_scan_id, max_scan_id):
+        if self.retain < 1 or min_scan_id is None or max_scan_id is None:
+            return None
+
+        self._ensure_loader()
+
+        return self.snapshots.get((min_scan_id, max_scan_id))
+
+    def _ensure_loader(self):
+        if self.pid == os.getpid() and self.thread is not None and self.thread.is_alive():
+            return
+
+        with self.lock:
+            if self.pid != os.getpid() or self.thread is None or not self.thread.is_alive():
+                if self.pid != os.getpid():
+                    # snapshots are private to the process that loaded them
+                    self.snapshots = dict()
+
+                self.pid = os.getpid()
+                self.thread = threading.Thread(target=self._run, name='follower-graph-loader')
+                self.thread.daemon = True
+                self.thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                with self.app.app_context():
+                    self.refresh()
+            except Exception:
+                logging.exception('follower graph refresh failed')
+
+            time.sleep(self.poll_interval)
+
+    def refresh(self):
+        try:
+            scans = Scan.query.filter(
+                Scan.type == Scan.SCAN_TYPE_FOLLOWERS,
+                Scan.end != None,
+                Scan.ref_start != None,
+                Scan.ref_end != None
+            ).order_by(Scan.id.desc()).limit(self.retain).all()
+        finally:
+            db.session.remove()
+
+        wanted = dict()
+        for scan in scans:
+            wanted[(int(scan.ref_start), int(scan.ref_end))] = scan.id
+
+        for (key, scan_id) in sorted(wanted.items(), key=lambda item: -item[1]):
+            if key not in self.snapshots:
+                self.snapshots[key] = self.load(scan_id, key[0], key[1])
+
+        for key in list(self.snapshots.keys()):
+            if key not in wanted:
+                del self.snapshots[key]
+
+    def load(self, scan_id, min_id, max_id):
+        start = time.time()
+
+        session = self.pool.get_session()
+        bound = self.pool.get_prepared(self.statement).bind((min_id, max_id))
+        bound.fetch_size = self.fetch_size
+
+        snapshot = FollowerGraphSnapshot.build(scan_id, min_id, max_id, session.execute(bound))
+
+        logging.info('loaded follower graph for scan %d: %d edges in %.1fs', scan_id, len(snapshot), time.time() - start)
+
+        return snapshot
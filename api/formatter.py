@@ -1,5 +1,8 @@
 from util import translate_virtual_time_to_alpha_time
 
+from tweet import Tweet
+from tuser import TUser
+
 class Formatter:
     def format(self, what):
         if isinstance(what, list):
@@ -34,6 +37,36 @@ class UserFormatter(Formatter):
             "url": user.website
         }
 
+    # the columns format_rows reads, in order; select these instead of whole TUser objects
+    COLUMNS = (TUser.bio, TUser.followers, TUser.following, TUser.user_id, TUser.location, TUser.full_name, TUser.profile_image_url,
+        TUser.profile_banner_url, TUser.protected, TUser.screen_name, TUser.total_tweets, TUser.website)
+
+    def format_rows(self, rows):
+        return [self.format_row(row) for row in rows]
+
+    def row_encoder(self):
+        return self.format_row
+
+    def format_row(self, row):
+        (bio, followers, following, user_id, location, full_name, profile_image_url, profile_banner_url, protected, screen_name, total_tweets, website) = row
+
+        return {
+            "created_at": None, # account creation time intentionally redacted
+            "description": bio,
+            "followers_count": int(followers),
+            "friends_count": int(following),
+            "id": int(user_id),
+            "id_str": str(user_id),
+            "location": location,
+            "name": full_name,
+            "profile_image_url": profile_image_url,
+            "profile_banner_url": profile_banner_url,
+            "protected": bool(protected),
+            "screen_name": screen_name,
+            "statuses_count": int(total_tweets),
+            "url": website
+        }
+
 class TweetFormatter(Formatter):
     def format_one(self, tweet):
         entities = {
@@ -70,6 +103,63 @@ class TweetFormatter(Formatter):
             "source": tweet.source
         }
 
+    # the columns format_rows reads, in order; project_tweets appends each tweet's entity types and texts
+    COLUMNS = (Tweet.tweet_id, Tweet.user_id, Tweet.timestamp, Tweet.text, Tweet.retweet_count_frozen, Tweet.retweet_status_id, Tweet.retweet_user_id,
+        Tweet.coordinates, Tweet.in_reply_to_screen_name, Tweet.in_reply_to_status_id, Tweet.in_reply_to_user_id, Tweet.source)
+
+    ENTITY_KEYS = {
+        'hashtag': 'hashtags',
+        'url': 'urls',
+        'mention': 'mentions'
+    }
+
+    def format_rows(self, rows):
+        # same output as format_many over Tweet objects
+        encode = self.row_encoder()
+        return [encode(row) for row in rows]
+
+    def row_encoder(self):
+        # virtual -> alpha time is a fixed offset, so work it out once rather than per tweet
+        offset = translate_virtual_time_to_alpha_time(0)
+        entity_keys = self.ENTITY_KEYS
+
+        def encode(row):
+            (tweet_id, user_id, timestamp, text, retweet_count, retweet_status_id, retweet_user_id, coordinates,
+                in_reply_to_screen_name, in_reply_to_status_id, in_reply_to_user_id, source, entity_types, entity_texts) = row
+
+            entities = {
+                'hashtags': [],
+                'urls': [],
+                'mentions': []
+            }
+
+            if entity_types is not None:
+                for (entity_type, entity_text) in zip(entity_types, entity_texts):
+                    if entity_type in entity_keys:
+                        entities[entity_keys[entity_type]].append(entity_text)
+
+            return {
+                "id": int(tweet_id),
+                "id_str": str(tweet_id),
+                "user_id": int(user_id),
+                "user_id_str": str(user_id),
+                "created_at": int(timestamp) + offset,
+                "text": text,
+                "retweet_count": retweet_count,
+                "retweet_status_id": retweet_status_id,
+                "retweet_user_id": retweet_user_id,
+                "entities": entities,
+                "coordinates": coordinates,
+                "in_reply_to_screen_name": in_reply_to_screen_name,
+                "in_reply_to_status_id": in_reply_to_status_id,
+                "in_reply_to_status_str": str(in_reply_to_status_id),
+                "in_reply_to_user_id": in_reply_to_user_id,
+                "in_reply_to_user_str": str(in_reply_to_user_id),
+                "source": source
+            }
+
+        return encode
+
 class EdgeFormatter(Formatter):
     def format_one(self, edge):
         return {
@@ -101,18 +191,26 @@ class GuessFormatter(Formatter):
         for user in guess.users:
             guesses.append(user.tuser_id)
 
+        return self.format_guess(guess.id, guess.timestamp, guesses, scores)
+
+    def format_guess(self, guess_id, timestamp, guesses, scores):
         guess_scores = []
         net_score = 0
 
         for (user_id, score) in scores.items():
+            # scores are keyed by the guessed integer id; a user that scored goes out as its twitter_id string,
+            # as it always has, and one that didn't as the integer
+            if score is not None:
+                user_id = str(user_id)
+
             guess_scores.append({"user_id": user_id, "score": score})
 
             if score is not None:
                 net_score += score
 
         return {
-            "guess_id": guess.id,
-            "timestamp": guess.timestamp,
+            "guess_id": guess_id,
+            "timestamp": timestamp,
             "guesses": guesses,
             "net_score": net_score,
             "scores": guess_scores
@@ -0,0 +1,75 @@
+import json
+import logging
+import os
+import tempfile
+import threading
+
+from collections import OrderedDict
+
+class HistoryCache:
+    # Finished responses that can no longer change, by key: a least recently used in-memory tier bounded by total
+    # body size, in front of an optional directory with one file per key. Entries are (status, headers, body).
+    def __init__(self, max_bytes, max_entry_bytes, directory=None):
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.size = 0
+
+        if directory is not None and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                self.entries[key] = entry
+                return entry
+
+        if self.directory is None:
+            return None
+
+        try:
+            with open(self._path(key), 'rb') as stored:
+                (status, headers) = json.loads(stored.readline())
+                entry = (status, headers, stored.read())
+        except (IOError, OSError, ValueError):
+            return None
+
+        self._remember(key, entry)
+
+        return entry
+
+    def set(self, key, entry):
+        if len(entry[2]) > self.max_entry_bytes:
+            return
+
+        self._remember(key, entry)
+
+        if self.directory is not None:
+            try:
+                # write then rename, so a reader never sees half a file
+                (handle, temporary) = tempfile.mkstemp(dir=self.directory)
+                with os.fdopen(handle, 'wb') as stored:
+                    stored.write(json.dumps([entry[0], entry[1]]) + '\n')
+                    stored.write(entry[2])
+                os.rename(temporary, self._path(key))
+            except (IOError, OSError):
+                logging.exception('could not store history cache entry %s', key)
+
+    def _remember(self, key, entry):
+        with self.lock:
+            previous = self.entries.pop(key, None)
+            if previous is not None:
+                self.size -= len(previous[2])
+
+            self.entries[key] = entry
+            self.size += len(entry[2])
+
+            while self.size > self.max_bytes and len(self.entries):
+                (evicted_key, evicted) = self.entries.popitem(last=False)
+                self.size -= len(evicted[2])
+
+    def _path(self, key):
+        return os.path.join(self.directory, key)
@@ -0,0 +1,77 @@
+import threading
+import time
+
+from sqlalchemy import String
+from sqlalchemy import func
+from sqlalchemy import literal
+from sqlalchemy.dialects.postgresql import ARRAY
+
+from tuser import TwitterUser
+from bot import Bot
+from database import db
+
+class ParticipantSet:
+    # twitter ids of the users in the competition, per value of the beta flag, reloaded every refresh_interval seconds
+    def __init__(self, refresh_interval=60):
+        self.refresh_interval = refresh_interval
+        self.lock = threading.Lock()
+        self.members = dict() # beta -> frozenset of twitter ids
+        self.ordered = dict() # beta -> sorted tuple of the same ids, for binding as one array
+        self.loaded = dict() # beta -> time of last load
+
+    def _refresh(self, beta):
+        if time.time() - self.loaded.get(beta, 0) < self.refresh_interval:
+            return
+
+        with self.lock:
+            if time.time() - self.loaded.get(beta, 0) < self.refresh_interval:
+                return
+
+            ids = [str(twitter_id) for (twitter_id,) in db.session.query(TwitterUser.twitter_id).filter(TwitterUser.beta == beta).all()]
+
+            self.ordered[beta] = tuple(sorted(ids))
+            self.members[beta] = frozenset(ids)
+            self.loaded[beta] = time.time()
+
+    def get(self, beta):
+        self._refresh(beta)
+        return self.members[beta]
+
+    def contains(self, beta, twitter_id):
+        return str(twitter_id) in self.get(beta)
+
+    def predicate(self, beta, column):
+        # column = ANY(:ids) with the whole set bound as a single array, so the planner sees a plain filter instead of a semi-join
+        self._refresh(beta)
+        return column == func.any(literal(list(self.ordered[beta]), ARRAY(String)))
+
+class BotSet:
+    # twitter ids of the competition bots, reloaded every refresh_interval seconds
+    def __init__(self, refresh_interval=60):
+        self.refresh_interval = refresh_interval
+        self.lock = threading.Lock()
+        self.ids = ()
+        self.members = frozenset()
+        self.loaded = 0
+
+    def _refresh(self):
+        if time.time() - self.loaded < self.refresh_interval:
+            return
+
+        with self.lock:
+            if time.time() - self.loaded < self.refresh_interval:
+                return
+
+            ids = tuple([str(twitter_id) for (twitter_id,) in db.session.query(Bot.twitter_id).all()])
+
+            self.ids = ids
+            self.members = frozenset(ids)
+            self.loaded = time.time()
+
+    def get(self):
+        self._refresh()
+        return self.members
+
+    def ordered(self):
+        self._refresh()
+        return self.ids
@@ -0,0 +1,28 @@
+from sqlalchemy import literal_column
+from sqlalchemy import select
+
+from database import db
+from tweet_entity import TweetEntity
+from formatter import TweetFormatter
+from formatter import UserFormatter
+
+def project_tweets(query):
+    # query is a filtered, ordered and limited Tweet query, newest first. Rather than loading Tweet objects with
+    # their entities eagerly joined, select TweetFormatter.COLUMNS for that page once and attach each tweet's
+    # entity types and texts as two arrays aggregated in SQL.
+    page = query.with_entities(*TweetFormatter.COLUMNS).cte('page')
+
+    entities = db.session.query(
+        TweetEntity.tweet_id.label('tweet_id'),
+        literal_column('array_agg(tweet_entity.type ORDER BY tweet_entity.id)').label('types'),
+        literal_column('array_agg(tweet_entity.text ORDER BY tweet_entity.id)').label('texts')
+    ).filter(
+        TweetEntity.tweet_id.in_(select([page.c.tweet_id]))
+    ).group_by(TweetEntity.tweet_id).subquery('page_entities')
+
+    return db.session.query(*(list(page.c) + [entities.c.types, entities.c.texts])).outerjoin(
+        entities, entities.c.tweet_id == page.c.tweet_id
+    ).order_by(page.c.tweet_id.desc())
+
+def project_users(query):
+    return query.with_entities(*UserFormatter.COLUMNS)
@@ -0,0 +1,56 @@
+import sys
+import database
+import logging
+
+from flask import Flask
+from ConfigParser import ConfigParser
+
+from detectionteam import DetectionTeam
+from team_scorecard import TeamScorecard
+from team_scorecard_user import TeamScorecardUser
+from team_scorecard_bot import TeamScorecardBot
+from scorecard import accumulate_guesses
+from scorecard import read_scorecard
+from scorecard import rebuild_scorecard
+
+config = ConfigParser()
+config.read('configuration.ini')
+
+app = Flask(__name__)
+app.config['SQLALCHEMY_DATABASE_URI'] = 'postgresql://%s:%s@/pacsocial?host=%s' % (config.get('postgresql', 'username'), config.get('postgresql', 'password'), config.get('postgresql', 'socket'))
+app.config['SQLALCHEMY_ECHO'] = False
+database.db.init_app(app)
+
+# usage: rebuild_scorecards.py [--check] [team_id ...]
+# --check compares the stored scorecards against a recomputation from guess/guess_users and writes nothing
+if __name__ == "__main__":
+    logging.getLogger().setLevel(logging.INFO)
+
+    check_only = '--check' in sys.argv
+    team_ids = [int(arg) for arg in sys.argv[1:] if arg != '--check']
+
+    with app.app_context():
+        for model in (TeamScorecard, TeamScorecardUser, TeamScorecardBot):
+            model.__table__.create(database.db.engine, checkfirst=True)
+
+        if not len(team_ids):
+            team_ids = [team.id for team in DetectionTeam.query.order_by(DetectionTeam.id).all()]
+
+        mismatches = 0
+
+        for team_id in team_ids:
+            if check_only:
+                stored = read_scorecard(team_id)
+                rebuilt = accumulate_guesses(team_id).result()
+
+                if stored != rebuilt:
+                    mismatches += 1
+                    logging.warn('team %d scorecard is %s, recomputed %s', team_id, stored, rebuilt)
+            else:
+                rebuild_scorecard(team_id)
+                database.db.session.commit()
+                logging.info('rebuilt scorecard for team %d', team_id)
+
+        if check_only:
+            logging.info('%d of %d scorecards differ', mismatches, len(team_ids))
+            sys.exit(1 if mismatches else 0)
@@ -0,0 +1,96 @@
+import bisect
+import threading
+import time
+
+from collections import namedtuple
+
+from sqlalchemy import or_
+from sqlalchemy import func
+
+from scan import Scan
+from database import db
+
+ScanRecord = namedtuple('ScanRecord', ['id', 'type', 'start', 'end', 'ref_start', 'ref_end'])
+
+class ScanIndex:
+    # Scans of each type sorted by end, with a running "highest id so far" so that the scan nearest_scan wants
+    # (highest id among those with end <= vtime) is one bisect away. The scan table only grows, so refreshing
+    # means fetching rows above the highest id seen plus any that had not finished yet. The scanner may set end
+    # before ref_start/ref_end, so a scan only counts as finished once all three are filled in.
+    def __init__(self, staleness=5):
+        self.staleness = staleness
+        self.lock = threading.Lock()
+        self.checked = 0
+        self.max_id = 0
+        self.records = dict() # id -> ScanRecord
+        self.unfinished = set() # ids whose end, ref_start or ref_end was still NULL
+        self.by_type = dict() # type -> (ends, best)
+
+    def nearest(self, scan_type, vtime):
+        self.refresh()
+
+        (ends, best) = self.by_type.get(scan_type, ([], []))
+        i = bisect.bisect_right(ends, vtime)
+
+        if i == 0:
+            return None
+
+        return best[i-1]
+
+    def latest_end(self, scan_type):
+        self.refresh()
+
+        (ends, best) = self.by_type.get(scan_type, ([], []))
+
+        if len(ends) == 0:
+            return None
+
+        return ends[-1]
+
+    def refresh(self, force=False):
+        if not force and time.time() - self.checked < self.staleness:
+            return
+
+        with self.lock:
+            if not force and time.time() - self.checked < self.staleness:
+                return
+
+            max_id = db.session.query(func.max(Scan.id)).scalar() or 0
+
+            if max_id > self.max_id or len(self.unfinished):
+                conditions = [Scan.id > self.max_id]
+                if len(self.unfinished):
+                    conditions.append(Scan.id.in_(list(self.unfinished)))
+
+                for scan in Scan.query.filter(or_(*conditions)).all():
+                    self.records[scan.id] = ScanRecord(scan.id, scan.type, scan.start, scan.end, scan.ref_start, scan.ref_end)
+
+                    if scan.end is None or scan.ref_start is None or scan.ref_end is None:
+                        self.unfinished.add(scan.id)
+                    else:
+                        self.unfinished.discard(scan.id)
+
+                self.max_id = max(self.max_id, max_id)
+                self._rebuild()
+
+            self.checked = time.time()
+
+    def _rebuild(self):
+        by_type = dict()
+
+        finished = [record for record in self.records.values() if record.end is not None]
+
+        for record in sorted(finished, key=lambda record: (record.end, record.id)):
+            if record.type not in by_type:
+                by_type[record.type] = ([], [])
+
+            (ends, best) = by_type[record.type]
+
+            if len(best) and best[-1].id > record.id:
+                best.append(best[-1])
+            else:
+                best.append(record)
+
+            ends.append(record.end)
+
+        self.by_type = by_type
@@ -0,0 +1,319 @@
+import bisect
+import math
+
+from sqlalchemy import func
+from sqlalchemy import text
+
+from cache import LRUCache
+from database import db
+from guess import Guess
+from guess_user import GuessUser
+from detectionteam import DetectionTeam
+from team_scorecard import TeamScorecard
+from team_scorecard_user import TeamScorecardUser
+from team_scorecard_bot import TeamScorecardBot
+
+from util import TIME_DETECTION_END
+from util import bot_set
+from util import score_guessed_users
+
+def compute_bonus(bots_guessed, bots_total, last_bot_timestamp):
+    # a team that has guessed every bot earns a day of bonus for every full day left after its last first-guess
+    if bots_guessed < bots_total or last_bot_timestamp is None:
+        return (False, 0)
+
+    return (True, math.ceil((float(TIME_DETECTION_END) - last_bot_timestamp)/86400)-1)
+
+def format_scorecard(net_score, positive_score, negative_score, finished, bonus):
+    return {
+        'score_subtotal': net_score,
+        'score_total': net_score + bonus,
+        'finished': finished,
+        'bonus': bonus,
+        'negative_score': negative_score,
+        'positive_score': positive_score
+    }
+
+def adjust_totals(card, score, sign):
+    # card is anything with net/positive/negative_score: an accumulator or a stored TeamScorecard
+    card.net_score += sign * score
+    if score > 0:
+        card.positive_score += sign * score
+    elif score < 0:
+        card.negative_score += sign * score
+
+class ScorecardAccumulator:
+    # A team's scorecard folded one guess at a time: latest score per user, running totals and the first time each bot was guessed.
+    def __init__(self, bots):
+        self.bots = frozenset(bots)
+        self.scores_by_user = dict() # user -> score; prevent same user counting multiple times
+        self.bot_first_timestamps = dict()
+        self.net_score = 0
+        self.positive_score = 0
+        self.negative_score = 0
+        self.last_bot_timestamp = None
+        self.last_guess_id = None
+
+    def add(self, guess_id, timestamp, scores):
+        for (user, score) in scores.items():
+            if score is not None:
+                if user in self.scores_by_user:
+                    adjust_totals(self, self.scores_by_user[user], -1)
+                self.scores_by_user[user] = score
+                adjust_totals(self, score, 1)
+
+            bot = str(user)
+            if bot in self.bots and (bot not in self.bot_first_timestamps or timestamp < self.bot_first_timestamps[bot]):
+                self.bot_first_timestamps[bot] = timestamp
+                self.last_bot_timestamp = max(self.bot_first_timestamps.values())
+
+        self.last_guess_id = guess_id
+
+    def result(self):
+        (finished, bonus) = compute_bonus(len(self.bot_first_timestamps), len(self.bots), self.last_bot_timestamp)
+        return format_scorecard(self.net_score, self.positive_score, self.negative_score, finished, bonus)
+
+SCORECARD_LOCK_NAMESPACE = 1 # first key of the two-key advisory lock, so team ids can't collide with other locks
+SCORECARD_MODELS = (TeamScorecard, TeamScorecardUser, TeamScorecardBot)
+
+existing_tables = set() # scorecard tables seen so far; nothing drops them, so only the missing ones are checked again
+
+def has_scorecard_tables():
+    # only rebuild_scorecards.py creates the scorecard tables; until it has, scorecards are computed from guesses
+    connection = db.session.connection()
+
+    for model in SCORECARD_MODELS:
+        if model.__tablename__ not in existing_tables and connection.dialect.has_table(connection, model.__tablename__):
+            existing_tables.add(model.__tablename__)
+
+    return len(existing_tables) == len(SCORECARD_MODELS)
+
+def lock_scorecard(team_id):
+    # Hold the team's scorecard lock for the rest of the transaction. A transaction-scoped advisory lock rather
+    # than FOR UPDATE, since a team's first guess has no row to lock yet.
+    db.session.execute(text('SELECT pg_advisory_xact_lock(:namespace, :team_id)'), {'namespace': SCORECARD_LOCK_NAMESPACE, 'team_id': team_id})
+
+def apply_guess(team_id, guess_id, timestamp, scores):
+    # Fold one new non-beta guess into the team's stored scorecard. Runs inside the caller's transaction,
+    # holding the team's scorecard lock so concurrent guesses from one team apply one after the other. The lock
+    # is taken even without the scorecard tables, so a rebuild_scorecards.py creating them waits for this guess.
+    lock_scorecard(team_id)
+
+    if not has_scorecard_tables():
+        return
+
+    card = TeamScorecard.query.filter(TeamScorecard.team_id == team_id).first()
+
+    if card is None or card.last_guess_id is None:
+        # a team without a card, or with one that has never seen a guess, may have earlier guesses (say
+        # rebuild_scorecards.py never ran), so recompute it from every guess, this one included since the caller
+        # has flushed it
+        if card is not None:
+            db.session.expunge(card)
+
+        rebuild_scorecard(team_id)
+        return
+
+    scored_users = [int(user) for (user, score) in scores.items() if score is not None]
+    user_rows = dict()
+
+    if len(scored_users):
+        for row in TeamScorecardUser.query.filter(TeamScorecardUser.team_id == team_id, TeamScorecardUser.tuser_id.in_(scored_users)).all():
+            user_rows[int(row.tuser_id)] = row
+
+    for (user, score) in scores.items():
+        if score is None:
+            continue
+
+        row = user_rows.get(int(user))
+
+        if row is None:
+            row = TeamScorecardUser(team_id=team_id, tuser_id=int(user), score=score)
+            user_rows[int(user)] = row
+            db.session.add(row)
+        else:
+            adjust_totals(card, row.score, -1)
+            row.score = score
+
+        adjust_totals(card, score, 1)
+
+    bots = bot_set.get()
+    guessed_bots = set([str(user) for user in scores.keys() if str(user) in bots])
+
+    if len(guessed_bots):
+        for row in TeamScorecardBot.query.filter(TeamScorecardBot.team_id == team_id, TeamScorecardBot.twitter_id.in_(list(guessed_bots))).all():
+            guessed_bots.discard(row.twitter_id)
+
+        for bot in guessed_bots:
+            db.session.add(TeamScorecardBot(team_id=team_id, twitter_id=bot, first_timestamp=int(timestamp)))
+            card.bots_guessed += 1
+            card.last_bot_timestamp = max(card.last_bot_timestamp or 0, int(timestamp))
+
+    card.last_guess_id = guess_id
+
+def read_scorecard(team_id):
+    if not has_scorecard_tables():
+        return None
+
+    card = TeamScorecard.query.filter(TeamScorecard.team_id == team_id).first()
+
+    if card is None:
+        return None
+
+    (finished, bonus) = compute_bonus(card.bots_guessed, len(bot_set.get()), card.last_bot_timestamp)
+    return format_scorecard(card.net_score, card.positive_score, card.negative_score, finished, bonus)
+
+def accumulate_guesses(team_id):
+    guesses = Guess.query.filter(Guess.beta == False, Guess.team_id == team_id).order_by(Guess.timestamp, Guess.id).all()
+
+    accumulator = ScorecardAccumulator(bot_set.ordered())
+
+    for guess in guesses:
+        accumulator.add(guess.id, guess.timestamp, score_guessed_users([user.tuser_id for user in guess.users]))
+
+    return accumulator
+
+def rebuild_scorecard(team_id):
+    # recompute a team's stored scorecard from guess/guess_users; the caller commits
+    lock_scorecard(team_id)
+
+    accumulator = accumulate_guesses(team_id)
+
+    TeamScorecardUser.query.filter(TeamScorecardUser.team_id == team_id).delete(synchronize_session=False)
+    TeamScorecardBot.query.filter(TeamScorecardBot.team_id == team_id).delete(synchronize_session=False)
+    TeamScorecard.query.filter(TeamScorecard.team_id == team_id).delete(synchronize_session=False)
+
+    db.session.add(TeamScorecard(
+        team_id=team_id,
+        net_score=accumulator.net_score,
+        positive_score=accumulator.positive_score,
+        negative_score=accumulator.negative_score,
+        bots_guessed=len(accumulator.bot_first_timestamps),
+        last_bot_timestamp=accumulator.last_bot_timestamp,
+        last_guess_id=accumulator.last_guess_id
+    ))
+
+    for (user, score) in accumulator.scores_by_user.items():
+        db.session.add(TeamScorecardUser(team_id=team_id, tuser_id=int(user), score=score))
+
+    for (bot, timestamp) in accumulator.bot_first_timestamps.items():
+        db.session.add(TeamScorecardBot(team_id=team_id, twitter_id=bot, first_timestamp=timestamp))
+
+    return accumulator
+
+class ScorecardTimeline:
+    # The scorecard after each distinct guess timestamp, so the scorecard as of any gtime is one bisect away.
+    def __init__(self, timestamps, scorecards, empty):
+        self.timestamps = timestamps
+        self.scorecards = scorecards
+        self.empty = empty
+
+    @classmethod
+    def build(cls, team_id):
+        guesses = Guess.query.filter(Guess.beta == False, Guess.team_id == team_id).order_by(Guess.timestamp, Guess.id).all()
+
+        accumulator = ScorecardAccumulator(bot_set.ordered())
+        empty = accumulator.result()
+
+        timestamps = []
+        scorecards = []
+
+        for (i, guess) in enumerate(guesses):
+            accumulator.add(guess.id, guess.timestamp, score_guessed_users([user.tuser_id for user in guess.users]))
+
+            if i + 1 == len(guesses) or guesses[i+1].timestamp != guess.timestamp:
+                timestamps.append(guess.timestamp)
+                scorecards.append(accumulator.result())
+
+        return cls(timestamps, scorecards, empty)
+
+    def at(self, gtime):
+        i = bisect.bisect_right(self.timestamps, gtime)
+
+        if i == 0:
+            return self.empty
+
+        return self.scorecards[i-1]
+
+    def series(self):
+        rv = []
+
+        for (timestamp, scorecard) in zip(self.timestamps, self.scorecards):
+            point = dict(scorecard)
+            point['timestamp'] = timestamp
+            rv.append(point)
+
+        return rv
+
+TIMELINE_CACHE_SIZE = 64
+
+timelines = LRUCache(TIMELINE_CACHE_SIZE)
+
+def get_timeline(team_id):
+    # cached per team until the team makes another non-beta guess or the bot roster changes
+    last_guess_id = db.session.query(func.max(Guess.id)).filter(Guess.beta == False, Guess.team_id == team_id).scalar()
+    version = (last_guess_id, bot_set.ordered())
+
+    cached = timelines.get(team_id)
+
+    if cached is not None and cached[0] == version:
+        return cached[1]
+
+    timeline = ScorecardTimeline.build(team_id)
+    timelines.set(team_id, (version, timeline))
+
+    return timeline
+
+leaderboards = LRUCache(1)
+
+def build_leaderboard():
+    # every team's scorecard from one pass over all non-beta guesses, scored against one copy of the bot set
+    rows = db.session.query(Guess.team_id, Guess.id, Guess.timestamp, GuessUser.tuser_id).join(
+        GuessUser, GuessUser.guess_id == Guess.id
+    ).filter(Guess.beta == False).order_by(Guess.timestamp, Guess.id).all()
+
+    bots = bot_set.ordered()
+    accumulators = dict()
+    guess_users = []
+
+    for (i, (team_id, guess_id, timestamp, tuser_id)) in enumerate(rows):
+        guess_users.append(tuser_id)
+
+        if i + 1 == len(rows) or rows[i+1][1] != guess_id:
+            if team_id not in accumulators:
+                accumulators[team_id] = ScorecardAccumulator(bots)
+            accumulators[team_id].add(guess_id, timestamp, score_guessed_users(guess_users))
+            guess_users = []
+
+    standings = []
+
+    for team in DetectionTeam.query.all():
+        if team.id in accumulators:
+            standing = accumulators[team.id].result()
+        else:
+            standing = ScorecardAccumulator(bots).result()
+
+        standing['team_id'] = team.id
+        standing['name'] = team.name
+        standings.append(standing)
+
+    standings.sort(key=lambda standing: (-standing['score_total'], standing['team_id']))
+
+    for (rank, standing) in enumerate(standings):
+        standing['rank'] = rank + 1
+
+    return standings
+
+def get_leaderboard():
+    # cached until someone makes another non-beta guess or the bot roster changes
+    version = (db.session.query(func.max(Guess.id)).filter(Guess.beta == False).scalar(), bot_set.ordered())
+
+    cached = leaderboards.get('leaderboard')
+
+    if cached is not None and cached[0] == version:
+        return cached[1]
+
+    leaderboard = build_leaderboard()
+    leaderboards.set('leaderboard', (version, leaderboard))
+
+    return leaderboard
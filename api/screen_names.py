@@ -0,0 +1,84 @@
+import threading
+
+from cache import LRUCache
+from database import db
+from scan import Scan
+from tuser import TUser
+
+LOOKUP_CACHE_SIZE = 4096
+
+NOT_LOOKED_UP = object()
+
+class ScreenNameMap:
+    # screen_name -> user_id per value of the beta flag, built from the observations of the latest finished user
+    # scan and rebuilt when a newer one finishes. Names that scan didn't observe are looked up in one query per
+    # batch and remembered, misses included, until the next rebuild.
+    def __init__(self, scan_index):
+        self.scan_index = scan_index
+        self.lock = threading.Lock()
+        self.maps = dict() # beta -> (scan id, observed names, looked up names)
+
+    def _current(self, beta):
+        scan = self.scan_index.nearest(Scan.SCAN_TYPE_USER, float('inf'))
+
+        if scan is None:
+            scan_id = None
+        else:
+            scan_id = scan.id
+
+        current = self.maps.get(beta)
+
+        if current is not None and current[0] == scan_id:
+            return current
+
+        with self.lock:
+            current = self.maps.get(beta)
+
+            if current is None or current[0] != scan_id:
+                observed = dict()
+
+                if scan is not None and scan.ref_start is not None and scan.ref_end is not None:
+                    # ascending id, so the latest observation of a name wins
+                    for (screen_name, user_id) in db.session.query(TUser.screen_name, TUser.user_id).filter(
+                        TUser.id >= int(scan.ref_start),
+                        TUser.id <= int(scan.ref_end),
+                        TUser.interesting == beta
+                    ).order_by(TUser.id).all():
+                        observed[screen_name] = user_id
+
+                current = (scan_id, observed, LRUCache(LOOKUP_CACHE_SIZE))
+                self.maps[beta] = current
+
+        return current
+
+    def resolve(self, beta, screen_names):
+        # screen_name -> user_id, or None for names no observation has
+        (scan_id, observed, looked_up) = self._current(beta)
+
+        rv = dict()
+        missing = []
+
+        for screen_name in set(screen_names):
+            if screen_name in observed:
+                rv[screen_name] = observed[screen_name]
+            else:
+                user_id = looked_up.get(screen_name, NOT_LOOKED_UP)
+                if user_id is NOT_LOOKED_UP:
+                    missing.append(screen_name)
+                else:
+                    rv[screen_name] = user_id
+
+        if len(missing):
+            found = dict()
+
+            for (screen_name, user_id) in db.session.query(TUser.screen_name, TUser.user_id).filter(
+                TUser.screen_name.in_(missing),
+                TUser.interesting == beta
+            ).order_by(TUser.id).all():
+                found[screen_name] = user_id
+
+            for screen_name in missing:
+                rv[screen_name] = found.get(screen_name)
+                looked_up.set(screen_name, rv[screen_name])
+
+        return rv
@@ -1,13 +1,23 @@
 from sqlalchemy import and_
 from sqlalchemy import or_
 
-from tuser import TUser
 from tweet_entity import TweetEntity
 from tweet import Tweet
 
-from util import beta_predicate_users
+from util import resolve_screen_names
+
+from cache import LRUCache
+from text_index import text_predicate
+from text_index import TEXT_BACKEND_SUBSTRING
+from entity_index import Intersection
+from entity_index import Union
+from entity_index import take
+from stage_timer import StageTimer
+from database import db
+from projection import project_tweets
 
 import logging
+import re
 
 class AndToken:
     def __repr__(self):
@@ -51,16 +61,6 @@ class ColonToken:
     def __str__(self):
         return ':'
 
-class StringCharacterToken:
-    def __init__(self, value):
-        self.value = value
-
-    def __repr__(self):
-        return 'StringCharacterToken[' + repr(self.value) + ']'
-
-    def __str__(self):
-        return self.value
-
 class StringToken:
     def __init__(self, value):
         self.value = value
@@ -113,6 +113,9 @@ class URLPredicate:
     def __str__(self):
         return 'url:' + str(self.url)
 
+    def entity(self):
+        return (TweetEntity.TYPE_URL, self.url)
+
 class MentionPredicate:
     def __init__(self, user):
         self.user = user
@@ -123,6 +126,9 @@ class MentionPredicate:
     def __str__(self):
         return '@' + str(self.user)
 
+    def entity(self):
+        return (TweetEntity.TYPE_MENTION, self.user)
+
 class HashtagPredicate:
     def __init__(self, hashtag):
         self.hashtag = hashtag
@@ -133,14 +139,53 @@ class HashtagPredicate:
     def __str__(self):
         return '#' + str(self.hashtag)
 
-class EOFError(Exception):
-    pass
+    def entity(self):
+        return (TweetEntity.TYPE_HASHTAG, self.hashtag)
+
+class UnresolvedMention:
+    # an @screen_name from the query; resolving it to a user id needs the database, so it happens after the cached parse
+    def __init__(self, screen_name):
+        self.screen_name = screen_name
+
+    def __repr__(self):
+        return 'UnresolvedMention[' + repr(self.screen_name) + ']'
+
+    def __str__(self):
+        return '@' + str(self.screen_name)
+
+ENTITY_PREDICATES = (URLPredicate, MentionPredicate, HashtagPredicate)
+
+PARSE_CACHE_SIZE = 4096
+
+# index candidates are checked against the database this many at a time, or for exact candidates as many as
+# the page still needs but at least the minimum
+CANDIDATE_BATCH_SIZE = 500
+CANDIDATE_MIN_BATCH_SIZE = 50
+
+# round trips of index candidates before the rest of the page comes from one query
+CANDIDATE_MAX_ROUNDS = 4
+
+# query string -> (trace lines, tokens with mentions unresolved)
+parse_cache = LRUCache(PARSE_CACHE_SIZE)
 
 class Search:
-    def __init__(self, data, debug):
-        self.position = 0
+    # +, ( and ) are not operators yet, so they lex as part of strings
+    TOKEN_PATTERN = re.compile(r'[:@# ]|[^:@# ]+')
+
+    SINGLE_CHARACTER_TOKENS = {
+        ':': ColonToken,
+        '@': MentionToken,
+        '#': HashtagToken,
+        ' ': OrToken
+    }
+
+    def __init__(self, data, debug, text_backend=TEXT_BACKEND_SUBSTRING, explain=False):
         self.data = data
         self.debug = debug
+        self.text_backend = text_backend
+        self.explain = explain
+        self.plans = []
+        self.timer = StageTimer()
 
     def expect(self, tokens, token_type):
         try:
@@ -152,58 +197,26 @@ class Search:
         except IndexError:
             raise SyntaxError("Unexpected end of string. Expecting %s" % (str(token_type)))
 
-    def advance(self):
-        self.position += 1
-
-        if len(self.data) == self.position:
-            self.position = 0
-            raise EOFError()
-
     def lex(self):
-        if len(self.data) == 0:
-            return []
-
         tokens = []
 
-        try:
-            while True:
-                token = self.get_token()
-                tokens.append(token)
-                self.advance()
-        except EOFError:
-            pass
+        for value in self.TOKEN_PATTERN.findall(self.data):
+            if value in self.SINGLE_CHARACTER_TOKENS:
+                tokens.append(self.SINGLE_CHARACTER_TOKENS[value]())
+            else:
+                tokens.append(StringToken(value))
 
         return tokens
-            
-    def get_token(self):
-        char = self.data[self.position]
-
-        if char == ':':
-            return ColonToken()
-        elif char == '@':
-            return MentionToken()
-        elif char == '#':
-            return HashtagToken()
-        elif char == ' ':
-            return OrToken()
-        elif False and char == '+':
-            return AndToken()
-        elif False and char == '(':
-            return OpeningParenthesesToken()
-        elif False and char == ')':
-            return ClosingParenthesesToken()
-        else:
-            return StringCharacterToken(char)
 
-    def parse(self):
-        self.debug.append('1. Parsing "%s"' % (self.data,))
+    def parse_syntax(self):
+        trace = []
 
         tokens = self.lex()
 
-        self.debug.append('2. Lexed "%s"' % (repr(tokens),))
+        trace.append('2. Lexed "%s"' % (repr(tokens),))
+        trace.append('3. Joined "%s"' % (repr(tokens),))
 
-        # join contiguous streams of StringCharacterToken's
-        joined_tokens = []
+        parsed_tokens = []
 
         skip_to = -1
         for i in range(len(tokens)):
@@ -211,58 +224,244 @@ class Search:
             if skip_to >= i:
                 continue
 
-            if isinstance(token, StringCharacterToken):
-                j = i
-                string = ""
-                while j < len(tokens) and isinstance(tokens[j], StringCharacterToken):
-                    string += str(tokens[j])
-                    j += 1
-                skip_to = j-1
-                joined_tokens.append(StringToken(string))
-            else:
-                joined_tokens.append(token)
-
-        self.debug.append('3. Joined "%s"' % (repr(joined_tokens),))
-
-        parsed_tokens = []
-
-        skip_to = -1
-        for i in range(len(joined_tokens)):
-            token = joined_tokens[i]
-            if skip_to >= i:
-                continue
+            has_operand = i+1 < len(tokens) and isinstance(tokens[i+1], StringToken)
 
-            if isinstance(token, ColonToken) and i > 0 and isinstance(joined_tokens[i-1], StringToken) and joined_tokens[i-1].value == 'url' and i < len(joined_tokens) and isinstance(joined_tokens[i+1], StringToken):
-                parsed_tokens.append(URLPredicate(str(joined_tokens[i+1])))
+            if isinstance(token, ColonToken) and i > 0 and isinstance(tokens[i-1], StringToken) and tokens[i-1].value == 'url' and has_operand:
+                parsed_tokens.append(URLPredicate(str(tokens[i+1])))
                 skip_to = i+1
-            elif isinstance(token, HashtagToken) and i < len(joined_tokens) and isinstance(joined_tokens[i+1], StringToken):
-                parsed_tokens.append(HashtagPredicate(str(joined_tokens[i+1])))
+            elif isinstance(token, HashtagToken) and has_operand:
+                parsed_tokens.append(HashtagPredicate(str(tokens[i+1])))
                 skip_to = i+1
-            elif isinstance(token, MentionToken) and i < len(joined_tokens) and isinstance(joined_tokens[i+1], StringToken):
-                screen_name = str(joined_tokens[i+1])
-                user = beta_predicate_users(TUser.query.filter(TUser.screen_name == screen_name)).first()
-                if user is not None:
-                    parsed_tokens.append(MentionPredicate(str(user.user_id)))
+            elif isinstance(token, MentionToken) and has_operand:
+                parsed_tokens.append(UnresolvedMention(str(tokens[i+1])))
                 skip_to = i+1
             else:
                 parsed_tokens.append(token)
 
+        return (trace, parsed_tokens)
+
+    def resolve_mentions(self, tokens):
+        screen_names = [token.screen_name for token in tokens if isinstance(token, UnresolvedMention)]
+
+        if not len(screen_names):
+            return tokens
+
+        user_ids = resolve_screen_names(screen_names)
+        resolved_tokens = []
+
+        for token in tokens:
+            if isinstance(token, UnresolvedMention):
+                if user_ids.get(token.screen_name) is not None:
+                    resolved_tokens.append(MentionPredicate(str(user_ids[token.screen_name])))
+            else:
+                resolved_tokens.append(token)
+
+        return resolved_tokens
+
+    def parse(self):
+        self.debug.append('1. Parsing "%s"' % (self.data,))
+
+        with self.timer.stage('parse'):
+            cached = parse_cache.get(self.data)
+
+            if cached is None:
+                cached = self.parse_syntax()
+                parse_cache.set(self.data, cached)
+
+        (trace, tokens) = cached
+        self.debug.extend(trace)
+
+        with self.timer.stage('mentions'):
+            parsed_tokens = self.resolve_mentions(tokens)
+
         self.debug.append('4. First Pass "%s"' % (repr(parsed_tokens),))
 
         return parsed_tokens
     
+    def build_tree(self, tokens):
+        # AND binds tighter than OR; terms with no operator between them are ORed, as the flat token list always was
+        tokens = [token for token in tokens if isinstance(token, (StringToken, AndToken, OpeningParenthesesToken, ClosingParenthesesToken) + ENTITY_PREDICATES)]
+
+        tree = None
+        position = 0
+
+        with self.timer.stage('parse'):
+            while position < len(tokens):
+                (right, position) = self.build_or(tokens, position)
+                tree = self.combine(OrConnexive, tree, right)
+                # skip an unmatched closing parenthesis
+                position += 1
+
+        self.debug.append('5. Tree "%s"' % (repr(tree),))
+
+        return tree
+
+    def combine(self, connexive, left, right):
+        if left is None:
+            return right
+        elif right is None:
+            return left
+        else:
+            return connexive(left, right)
+
+    def build_or(self, tokens, position):
+        (tree, position) = self.build_and(tokens, position)
+
+        while position < len(tokens) and not isinstance(tokens[position], ClosingParenthesesToken):
+            (right, position) = self.build_and(tokens, position)
+            tree = self.combine(OrConnexive, tree, right)
+
+        return (tree, position)
+
+    def build_and(self, tokens, position):
+        (tree, position) = self.build_term(tokens, position)
+
+        while position < len(tokens) and isinstance(tokens[position], AndToken):
+            (right, position) = self.build_term(tokens, position + 1)
+            tree = self.combine(AndConnexive, tree, right)
+
+        return (tree, position)
+
+    def build_term(self, tokens, position):
+        if position >= len(tokens) or isinstance(tokens[position], ClosingParenthesesToken):
+            return (None, position)
+
+        token = tokens[position]
+
+        if isinstance(token, OpeningParenthesesToken):
+            (tree, position) = self.build_or(tokens, position + 1)
+            return (tree, position + 1)
+        elif isinstance(token, AndToken):
+            return (None, position + 1)
+        else:
+            return (token, position + 1)
+
     def apply(self, query, tree):
-        # for now, tree is just a set of ORs
-        ors = []
-
-        for token in tree:
-            if isinstance(token, HashtagPredicate):
-                ors.append(and_(TweetEntity.type == TweetEntity.TYPE_HASHTAG, TweetEntity.text == token.hashtag))
-            elif isinstance(token, MentionPredicate):
-                ors.append(and_(TweetEntity.type == TweetEntity.TYPE_MENTION, TweetEntity.text == token.user))
-            elif isinstance(token, URLPredicate):
-                ors.append(and_(TweetEntity.type == TweetEntity.TYPE_URL, TweetEntity.text == token.url))
-            elif isinstance(token, StringToken):
-                ors.append(Tweet.text.contains(str(token)))
-
-        return or_(*ors)
+        if isinstance(tree, OrConnexive):
+            return or_(self.apply(query, tree.left), self.apply(query, tree.right))
+        elif isinstance(tree, AndConnexive):
+            return and_(self.apply(query, tree.left), self.apply(query, tree.right))
+        elif isinstance(tree, ENTITY_PREDICATES):
+            (entity_type, text) = tree.entity()
+            return Tweet.entities.any(and_(TweetEntity.type == entity_type, TweetEntity.text == text))
+        elif isinstance(tree, StringToken):
+            return text_predicate(Tweet.text, str(tree), self.text_backend)
+        else:
+            return or_()
+
+    def candidates(self, tree, postings, since_id, max_id):
+        # a cursor over the tweet ids in (since_id, max_id] that may match tree, newest first, and whether all of
+        # them certainly do; None when the tree has a branch the index can't answer (free text), so it can't narrow
+        # anything. Nothing is read from the postings until the cursor is walked.
+        if isinstance(tree, OrConnexive):
+            operands = []
+            pending = [tree]
+
+            while len(pending):
+                node = pending.pop()
+                if isinstance(node, OrConnexive):
+                    pending.extend([node.left, node.right])
+                else:
+                    operands.append(self.candidates(node, postings, since_id, max_id))
+
+            if any([ids is None for (ids, exact) in operands]):
+                return (None, False)
+
+            return (Union([ids for (ids, exact) in operands]), all([exact for (ids, exact) in operands]))
+        elif isinstance(tree, AndConnexive):
+            (left, left_exact) = self.candidates(tree.left, postings, since_id, max_id)
+            (right, right_exact) = self.candidates(tree.right, postings, since_id, max_id)
+
+            if left is None:
+                return (right, False)
+            elif right is None:
+                return (left, False)
+
+            return (Intersection([left, right]), left_exact and right_exact)
+        elif isinstance(tree, ENTITY_PREDICATES):
+            (entity_type, text) = tree.entity()
+            return (postings.window(entity_type, text, since_id, max_id), True)
+        else:
+            return (None, False)
+
+    def fetch(self, query, tree, index, since_id, max_id, since_count, now):
+        # query is the ordered, filtered tweet query without the search predicate, for tweets before virtual time now
+        since_count = int(since_count)
+        predicate = self.apply(query, tree)
+
+        postings = None
+        if index is not None and tree is not None:
+            postings = index.current()
+
+        if postings is None:
+            return self.execute(query.filter(predicate).limit(since_count))
+
+        covered = postings.covered_tweet_id()
+        tweets = []
+
+        if max_id > covered:
+            # tweets newer than the last index refresh
+            tweets = self.execute(query.filter(Tweet.tweet_id > covered, predicate).limit(since_count))
+            max_id = covered
+
+        with self.timer.stage('index'):
+            # indexed tweets above the ceiling are all after now, so the walk starts below them
+            ceiling = postings.tweet_id_ceiling(now)
+            (ids, exact) = self.candidates(tree, postings, since_id, min(max_id, ceiling if ceiling is not None else since_id))
+
+        if ids is None:
+            self.debug.append('6. Index not applicable')
+            return tweets + self.execute(query.filter(Tweet.tweet_id <= max_id, predicate).limit(since_count - len(tweets)))
+
+        # exact candidates all match the tree, so only about as many as the page still needs are taken (they can
+        # still fail the query's own filters); inexact ones go in batches. Sparse matches that would take many
+        # round trips are finished with one query below the next candidate.
+        read = 0
+        rounds = 0
+        fallback = False
+
+        while len(tweets) < since_count:
+            if rounds == CANDIDATE_MAX_ROUNDS:
+                if ids.current() is not None:
+                    fallback = True
+                    tweets.extend(self.execute(query.filter(Tweet.tweet_id <= ids.current(), predicate).limit(since_count - len(tweets))))
+
+                break
+
+            if exact:
+                count = max(since_count - len(tweets), CANDIDATE_MIN_BATCH_SIZE)
+            else:
+                count = CANDIDATE_BATCH_SIZE
+
+            with self.timer.stage('index'):
+                batch = take(ids, count)
+
+            if not len(batch):
+                break
+
+            read += len(batch)
+            rounds += 1
+
+            batch_query = query.filter(Tweet.tweet_id.in_(batch))
+            if not exact:
+                batch_query = batch_query.filter(predicate)
+
+            tweets.extend(self.execute(batch_query.limit(since_count - len(tweets))))
+
+        self.debug.append('6. Index candidates read: %d in %d rounds, exact: %s, finished in SQL: %s' % (read, rounds, exact, fallback))
+
+        return tweets
+
+    def execute(self, query):
+        # rows in the shape TweetFormatter.format_rows takes
+        query = project_tweets(query)
+
+        if self.explain:
+            with self.timer.stage('explain'):
+                # str() of the compiled statement uses the driver's placeholders, so run it below the ORM with the driver's params
+                compiled = query.statement.compile(dialect=db.engine.dialect)
+                plan = db.session.connection().execute('EXPLAIN (ANALYZE, FORMAT JSON) ' + str(compiled), compiled.params).scalar()
+                self.plans.append(plan)
+
+        with self.timer.stage('sql'):
+            return query.all()
@@ -0,0 +1,31 @@
+import time
+
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from statsd import statsd
+
+class StageTimer:
+    # wall time spent in each named stage of one request, in the order the stages first ran; a stage entered
+    # more than once accumulates
+    def __init__(self):
+        self.stages = OrderedDict()
+
+    @contextmanager
+    def stage(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0) + (time.time() - start)
+
+    def milliseconds(self):
+        return OrderedDict([(name, round(elapsed * 1000, 3)) for (name, elapsed) in self.stages.items()])
+
+    def server_timing(self):
+        return ', '.join(['%s;dur=%.3f' % (name, elapsed * 1000) for (name, elapsed) in self.stages.items()])
+
+    def report(self, metric, tags, sample_rate):
+        # statsd drops all but sample_rate of these client side, so calling this on every request is cheap
+        for (name, elapsed) in self.stages.items():
+            statsd.timing(metric + '.' + name, elapsed, tags=tags, sample_rate=sample_rate)
@@ -0,0 +1,12 @@
+from database import db
+
+class TeamScorecard(db.Model):
+    __tablename__ = "team_scorecard"
+
+    team_id             = db.Column(db.Integer(), primary_key=True)
+    net_score           = db.Column(db.Float())
+    positive_score      = db.Column(db.Float())
+    negative_score      = db.Column(db.Float())
+    bots_guessed        = db.Column(db.Integer())
+    last_bot_timestamp  = db.Column(db.Integer()) # latest of the first-guess timestamps over every bot guessed
+    last_guess_id       = db.Column(db.Integer())
@@ -0,0 +1,8 @@
+from database import db
+
+class TeamScorecardBot(db.Model):
+    __tablename__ = "team_scorecard_bot"
+
+    team_id         = db.Column(db.Integer(), primary_key=True)
+    twitter_id      = db.Column(db.String(32), primary_key=True)
+    first_timestamp = db.Column(db.Integer())
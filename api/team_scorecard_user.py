@@ -0,0 +1,8 @@
+from database import db
+
+class TeamScorecardUser(db.Model):
+    __tablename__ = "team_scorecard_user"
+
+    team_id     = db.Column(db.Integer(), primary_key=True)
+    tuser_id    = db.Column(db.BigInteger(), primary_key=True)
+    score       = db.Column(db.Float())
@@ -0,0 +1,26 @@
+from sqlalchemy import func
+from sqlalchemy import literal_column
+
+# substring keeps LIKE '%term%' semantics, which the trigram index can answer;
+# fulltext matches whole stemmed words through the tsvector index
+TEXT_BACKEND_SUBSTRING = 'substring'
+TEXT_BACKEND_FULLTEXT = 'fulltext'
+TEXT_BACKENDS = (TEXT_BACKEND_SUBSTRING, TEXT_BACKEND_FULLTEXT)
+
+# must match the configuration in the tsvector index expression below, or the planner won't use the index
+TEXT_SEARCH_CONFIG = 'english'
+
+TEXT_EXTENSION_DDL = "CREATE EXTENSION IF NOT EXISTS pg_trgm"
+
+# (index name, DDL); PostgreSQL 9.4 has no CREATE INDEX IF NOT EXISTS, so callers check pg_indexes for the name first
+TEXT_INDEXES = [
+    ('tweet_text_trgm_idx', "CREATE INDEX CONCURRENTLY tweet_text_trgm_idx ON tweet USING gin (text gin_trgm_ops)"),
+    ('tweet_text_tsv_idx', "CREATE INDEX CONCURRENTLY tweet_text_tsv_idx ON tweet USING gin (to_tsvector('%s'::regconfig, text))" % (TEXT_SEARCH_CONFIG,))
+]
+
+def text_predicate(column, term, backend=TEXT_BACKEND_SUBSTRING):
+    if backend == TEXT_BACKEND_FULLTEXT:
+        config = literal_column("'%s'::regconfig" % (TEXT_SEARCH_CONFIG,))
+        return func.to_tsvector(config, column).op('@@')(func.plainto_tsquery(config, term))
+    else:
+        return column.contains(term)
@@ -0,0 +1,178 @@
+import bisect
+import threading
+import time
+
+from sqlalchemy import and_
+from sqlalchemy import or_
+from sqlalchemy import func
+
+from database import db
+from tweet import Tweet
+from watermark import CommitWatermark
+
+class Buckets:
+    # tweet counts per integer bucket, with prefix sums over the buckets in order so a range of whole buckets sums
+    # in two bisects; also a running maximum of each bucket's latest timestamp, in the same order
+    def __init__(self):
+        self.counts = dict()
+        self.max_timestamps = dict()
+        self.keys = []
+        self.prefix = [0]
+        self.running_max = []
+
+    def add(self, bucket, count, max_timestamp):
+        self.counts[bucket] = self.counts.get(bucket, 0) + count
+        self.max_timestamps[bucket] = max(self.max_timestamps.get(bucket, max_timestamp), max_timestamp)
+
+    def rebuild(self):
+        keys = sorted(self.counts.keys())
+        prefix = [0]
+        running_max = []
+
+        for key in keys:
+            prefix.append(prefix[-1] + self.counts[key])
+            running_max.append(max(running_max[-1] if len(running_max) else self.max_timestamps[key], self.max_timestamps[key]))
+
+        (self.keys, self.prefix, self.running_max) = (keys, prefix, running_max)
+
+    def total(self, lo, hi):
+        # tweets in buckets lo <= bucket < hi
+        return self.prefix[bisect.bisect_left(self.keys, hi)] - self.prefix[bisect.bisect_left(self.keys, lo)]
+
+    def settled_until(self, timestamp):
+        # every bucket below the one returned holds only tweets at or before timestamp; None if every bucket does
+        i = bisect.bisect_right(self.running_max, timestamp)
+
+        if i == len(self.keys):
+            return None
+
+        return self.keys[i]
+
+class TweetHistogram:
+    # Participant tweet counts per bucket of virtual timestamp and per bucket of tweet_id, for each value of the
+    # beta flag, covering the tweet rows up to last_id. New rows are folded in by tweet.id at most every staleness
+    # seconds, only as far as the commit watermark, and the whole histogram is rebuilt if the participant set
+    # changes. Counts come out exact: the partial buckets at either end of a range, and rows above last_id, are
+    # counted in SQL.
+    def __init__(self, participant_set, start, time_bucket=60, id_bucket=2**38, staleness=5):
+        self.participant_set = participant_set
+        self.start = start
+        self.time_bucket = time_bucket
+        self.id_bucket = id_bucket
+        self.staleness = staleness
+        self.lock = threading.Lock()
+        self.watermark = CommitWatermark(Tweet.id)
+        self.states = dict() # beta -> (participants, last_id, checked, time buckets, id buckets)
+
+    def _state(self, beta):
+        self.participant_set.get(beta)
+        participants = self.participant_set.ordered[beta]
+
+        state = self.states.get(beta)
+
+        if state is not None and state[0] == participants and time.time() - state[2] < self.staleness:
+            return state
+
+        with self.lock:
+            state = self.states.get(beta)
+
+            if state is None or state[0] != participants:
+                state = (participants, 0, 0, Buckets(), Buckets())
+
+            if time.time() - state[2] >= self.staleness:
+                (participants, last_id, checked, by_time, by_id) = state
+                max_id = max(last_id, self.watermark.advance())
+
+                if max_id > last_id:
+                    self._fold(beta, last_id, max_id, by_time, by_id)
+
+                state = (participants, max_id, time.time(), by_time, by_id)
+                self.states[beta] = state
+
+        return state
+
+    def _fold(self, beta, last_id, max_id, by_time, by_id):
+        conditions = [
+            self.participant_set.predicate(beta, Tweet.user_id),
+            Tweet.timestamp >= self.start,
+            Tweet.id > last_id,
+            Tweet.id <= max_id
+        ]
+
+        time_bucket = ((Tweet.timestamp - self.start) / self.time_bucket).label('bucket')
+        for (bucket, count, max_timestamp) in db.session.query(time_bucket, func.count(Tweet.id), func.max(Tweet.timestamp)).filter(*conditions).group_by('bucket').all():
+            by_time.add(int(bucket), count, max_timestamp)
+
+        id_bucket = (Tweet.tweet_id / self.id_bucket).label('bucket')
+        for (bucket, count, max_timestamp) in db.session.query(id_bucket, func.count(Tweet.id), func.max(Tweet.timestamp)).filter(*conditions).group_by('bucket').all():
+            by_id.add(int(bucket), count, max_timestamp)
+
+        by_time.rebuild()
+        by_id.rebuild()
+
+    def _exact(self, beta, now, ranges):
+        # participant tweets up to now matching any of ranges, straight from the tweet table
+        if not len(ranges):
+            return 0
+
+        return db.session.query(func.count(Tweet.id)).filter(
+            self.participant_set.predicate(beta, Tweet.user_id),
+            Tweet.timestamp >= self.start,
+            Tweet.timestamp <= now,
+            or_(*ranges)
+        ).scalar()
+
+    def count_by_time(self, beta, start, end, now):
+        # participant tweets with start <= timestamp < end and timestamp <= now, all virtual times
+        (participants, last_id, checked, by_time, by_id) = self._state(beta)
+
+        start = max(start, self.start)
+        end = min(end, int(now) + 1)
+
+        if start >= end:
+            return 0
+
+        lo = -(-(start - self.start) // self.time_bucket)
+        hi = (end - self.start) // self.time_bucket
+        lo_timestamp = self.start + lo * self.time_bucket
+        hi_timestamp = self.start + hi * self.time_bucket
+
+        if lo >= hi:
+            return self._exact(beta, now, [and_(Tweet.timestamp >= start, Tweet.timestamp < end)])
+
+        ranges = [and_(Tweet.id > last_id, Tweet.timestamp >= lo_timestamp, Tweet.timestamp < hi_timestamp)]
+        if start < lo_timestamp:
+            ranges.append(and_(Tweet.timestamp >= start, Tweet.timestamp < lo_timestamp))
+        if hi_timestamp < end:
+            ranges.append(and_(Tweet.timestamp >= hi_timestamp, Tweet.timestamp < end))
+
+        return by_time.total(lo, hi) + self._exact(beta, now, ranges)
+
+    def count_by_id(self, beta, start, end, now):
+        # participant tweets with start <= tweet_id < end and timestamp <= now
+        (participants, last_id, checked, by_time, by_id) = self._state(beta)
+
+        if start >= end:
+            return 0
+
+        lo = -(-start // self.id_bucket)
+        hi = end // self.id_bucket
+
+        # buckets holding tweets after now are counted in SQL, so the histogram only answers for settled ones
+        unsettled = by_id.settled_until(now)
+        if unsettled is not None:
+            hi = min(hi, max(lo, unsettled))
+
+        lo_id = lo * self.id_bucket
+        hi_id = hi * self.id_bucket
+
+        if lo >= hi:
+            return self._exact(beta, now, [and_(Tweet.tweet_id >= start, Tweet.tweet_id < end)])
+
+        ranges = [and_(Tweet.id > last_id, Tweet.tweet_id >= lo_id, Tweet.tweet_id < hi_id)]
+        if start < lo_id:
+            ranges.append(and_(Tweet.tweet_id >= start, Tweet.tweet_id < lo_id))
+        if hi_id < end:
+            ranges.append(and_(Tweet.tweet_id >= hi_id, Tweet.tweet_id < end))
+
+        return by_id.total(lo, hi) + self._exact(beta, now, ranges)
@@ -2,17 +2,25 @@ from statsd import statsd
 
 import logging
 import time
-import math
 import json
 import flask
+import base64
+import struct
+import hashlib
+import itertools
+import threading
 
 from functools import wraps
 
+from sqlalchemy import func
+
 from tweet import Tweet
 from tuser import TUser
-from scan import Scan
 from tuser import TwitterUser
-from bot import Bot
+from scan_index import ScanIndex
+from participants import ParticipantSet
+from participants import BotSet
+from screen_names import ScreenNameMap
 
 from database import db
 
@@ -26,6 +34,17 @@ TIME_DETECTION_END = 1426564800         # March 17, 2015 at Midnight EST
 GENEROUS_CURSOR_UPPER_BOUND = 15000
 DEFAULT_CURSOR_SIZE = 500
 
+SCAN_INDEX_STALENESS = 5 # seconds a newly finished scan may go unnoticed
+
+scan_index = ScanIndex(staleness=SCAN_INDEX_STALENESS)
+
+PARTICIPANT_REFRESH_INTERVAL = 60
+
+participant_set = ParticipantSet(refresh_interval=PARTICIPANT_REFRESH_INTERVAL)
+bot_set = BotSet(refresh_interval=PARTICIPANT_REFRESH_INTERVAL)
+
+screen_names = ScreenNameMap(scan_index)
+
 def get_time_anchor():
     now = time.time()
 
@@ -80,7 +99,13 @@ def timeline(default_cursor_size = None):
         return decorator
     return deco
 
+KEYSET_AFTER = 'a'
+KEYSET_BEFORE = 'b'
+
 def cursor(default_cursor_size = None):
+    # X-Cursor is either an offset cursor, "<offset>-<size>", or a keyset cursor, "a<id>-<size>" for the page after
+    # (below) id or "b<id>-<size>" for the page before (above) it. Handlers that report the ids bounding their page
+    # with keyset_page get keyset cursors back; offset cursors are still accepted and still answered for the rest.
     if None is default_cursor_size:
         default_cursor_size = DEFAULT_CURSOR_SIZE
 
@@ -88,12 +113,30 @@ def cursor(default_cursor_size = None):
         @wraps(f)
         def decorator(*args, **kwargs):
             cursor = None
+            after_id = None
+            before_id = None
 
             if 'X-Cursor' in flask.request.headers:
                 cursor = flask.request.headers['X-Cursor']
-                (offset, cursor_size) = cursor.split('-')
-                offset = int(offset)
-                cursor_size = int(cursor_size)
+
+                if cursor[:1] in (KEYSET_AFTER, KEYSET_BEFORE):
+                    try:
+                        (boundary_id, cursor_size) = cursor[1:].split('-')
+                        boundary_id = int(boundary_id)
+                        cursor_size = min(GENEROUS_CURSOR_UPPER_BOUND, int(cursor_size))
+                    except ValueError:
+                        return flask.make_response('', 400)
+
+                    if cursor[:1] == KEYSET_AFTER:
+                        after_id = boundary_id
+                    else:
+                        before_id = boundary_id
+
+                    offset = 0
+                else:
+                    (offset, cursor_size) = cursor.split('-')
+                    offset = int(offset)
+                    cursor_size = int(cursor_size)
 
             elif 'X-Cursor-Size' in flask.request.headers:
                 cursor_size = min(GENEROUS_CURSOR_UPPER_BOUND, int(flask.request.headers['X-Cursor-Size']))
@@ -106,14 +149,25 @@ def cursor(default_cursor_size = None):
 
             kwargs['cursor_size'] = cursor_size
             kwargs['offset'] = offset
+            kwargs['after_id'] = after_id
+            kwargs['before_id'] = before_id
 
             @flask.after_this_request
             def add_header(response):
-                if offset > 0:
-                    prev_cursor = str(offset - cursor_size) + '-' + str(cursor_size)
-                    response.headers['X-Cursor-Previous'] = prev_cursor
+                first_id = getattr(flask.g, 'cursor_first_id', None)
+                last_id = getattr(flask.g, 'cursor_last_id', None)
+
+                if first_id is not None:
+                    if offset > 0 or after_id is not None or before_id is not None:
+                        response.headers['X-Cursor-Previous'] = '%s%d-%d' % (KEYSET_BEFORE, first_id, cursor_size)
+
+                    response.headers['X-Cursor-Next'] = '%s%d-%d' % (KEYSET_AFTER, last_id, cursor_size)
+                elif after_id is None and before_id is None:
+                    if offset > 0:
+                        prev_cursor = str(offset - cursor_size) + '-' + str(cursor_size)
+                        response.headers['X-Cursor-Previous'] = prev_cursor
 
-                response.headers['X-Cursor-Next'] = next_cursor
+                    response.headers['X-Cursor-Next'] = next_cursor
 
                 if cursor is not None:
                     response.headers['X-Cursor-Current'] = cursor
@@ -125,13 +179,155 @@ def cursor(default_cursor_size = None):
         return decorator
     return deco
 
+def keyset_page(query, column, cursor_size, offset, after_id, before_id):
+    # (highest, lowest) value of column on the requested page of query in descending order, or (None, None) when the
+    # page is empty. Only the two bounds leave the database, so this can run before a streamed body, and a deep
+    # keyset page costs the same as the first. The bounds become the cursor decorator's keyset cursors.
+    page = query.with_entities(column.label('boundary'))
+
+    if after_id is not None:
+        page = page.filter(column < after_id).order_by(column.desc())
+    elif before_id is not None:
+        page = page.filter(column > before_id).order_by(column.asc())
+    else:
+        page = page.order_by(column.desc()).offset(offset)
+
+    page = page.limit(cursor_size).subquery()
+
+    (first_id, last_id) = db.session.query(func.max(page.c.boundary), func.min(page.c.boundary)).one()
+
+    flask.g.cursor_first_id = first_id
+    flask.g.cursor_last_id = last_id
+
+    return (first_id, last_id)
+
+PAGING_CURSOR_DRIVER_STATE = 0
+PAGING_CURSOR_EDGE_ID = 1
+
+PAGING_CURSOR_HEADER = '>IB'
+PAGING_CURSOR_HEADER_BYTES = struct.calcsize(PAGING_CURSOR_HEADER)
+PAGING_BINDING_BYTES = 8
+
+def paging_binding(kwargs):
+    # what a cursor was issued for: the route, its path parameters other than vtime and the scan window, so one
+    # query's paging state never reaches the driver bound to another query's parameters
+    view_args = sorted([(name, value) for (name, value) in flask.request.view_args.items() if name != 'vtime'])
+    return hashlib.sha1(repr((flask.request.endpoint, view_args, kwargs['min_scan_id'], kwargs['max_scan_id']))).digest()[:PAGING_BINDING_BYTES]
+
+def encode_paging_cursor(fetch_size, kind, binding, payload):
+    return base64.urlsafe_b64encode(struct.pack(PAGING_CURSOR_HEADER, fetch_size, kind) + binding + payload)
+
+def decode_paging_cursor(cursor):
+    try:
+        raw = base64.urlsafe_b64decode(str(cursor))
+    except TypeError:
+        raise ValueError('malformed cursor')
+
+    if len(raw) <= PAGING_CURSOR_HEADER_BYTES + PAGING_BINDING_BYTES:
+        raise ValueError('malformed cursor')
+
+    (fetch_size, kind) = struct.unpack(PAGING_CURSOR_HEADER, raw[:PAGING_CURSOR_HEADER_BYTES])
+    binding = raw[PAGING_CURSOR_HEADER_BYTES:PAGING_CURSOR_HEADER_BYTES + PAGING_BINDING_BYTES]
+    payload = raw[PAGING_CURSOR_HEADER_BYTES + PAGING_BINDING_BYTES:]
+
+    if fetch_size < 1 or fetch_size > GENEROUS_CURSOR_UPPER_BOUND:
+        raise ValueError('malformed cursor')
+
+    if kind == PAGING_CURSOR_EDGE_ID and len(payload) == 8:
+        (payload,) = struct.unpack('>q', payload)
+    elif kind != PAGING_CURSOR_DRIVER_STATE:
+        raise ValueError('malformed cursor')
+
+    return (fetch_size, kind, binding, payload)
+
+def paged(f):
+    # Opaque edge cursors: the driver's paging state for pages read from Cassandra, or the last edge id for pages
+    # served from a follower graph snapshot. The page size travels inside the cursor so every page of a walk is the same size,
+    # and a cursor is only accepted by the route, user and scan window it was issued for.
+    @wraps(f)
+    def decorator(*args, **kwargs):
+        cursor = None
+        paging_state = None
+        binding = paging_binding(kwargs)
+
+        if 'X-Cursor' in flask.request.headers:
+            cursor = flask.request.headers['X-Cursor']
+
+            try:
+                (kwargs['since_count'], kind, cursor_binding, payload) = decode_paging_cursor(cursor)
+            except ValueError:
+                return flask.make_response('', 400)
+
+            if cursor_binding != binding:
+                return flask.make_response('', 400)
+
+            if kind == PAGING_CURSOR_DRIVER_STATE:
+                paging_state = payload
+            else:
+                kwargs['max_id'] = min(kwargs['max_id'], payload - 1)
+
+        kwargs['paging_state'] = paging_state
+        fetch_size = kwargs['since_count']
+
+        @flask.after_this_request
+        def add_header(response):
+            next_paging_state = getattr(flask.g, 'next_paging_state', None)
+            next_edge_id = getattr(flask.g, 'next_edge_id', None)
+
+            if next_paging_state is not None:
+                response.headers['X-Cursor-Next'] = encode_paging_cursor(fetch_size, PAGING_CURSOR_DRIVER_STATE, binding, next_paging_state)
+            elif next_edge_id is not None:
+                response.headers['X-Cursor-Next'] = encode_paging_cursor(fetch_size, PAGING_CURSOR_EDGE_ID, binding, struct.pack('>q', next_edge_id))
+
+            if cursor is not None:
+                response.headers['X-Cursor-Current'] = cursor
+
+            return response
+
+        return f(*args, **kwargs)
+
+    return decorator
+
+STREAM_FETCH_SIZE = 1000 # rows per round trip on a server side cursor
+STREAM_CHUNK_ITEMS = 100 # array elements per chunk written to the client
+
+def stream_json_array(items, encode):
+    # A JSON array written a chunk at a time as items are encoded. An empty array is returned whole so
+    # make_json_response can still turn it into a 204.
+    items = iter(items)
+
+    try:
+        first = next(items)
+    except StopIteration:
+        return json.dumps([])
+
+    def generate():
+        chunk = ['[', json.dumps(encode(first))]
+
+        for item in items:
+            chunk.append(', ')
+            chunk.append(json.dumps(encode(item)))
+
+            if len(chunk) >= 2 * STREAM_CHUNK_ITEMS:
+                yield ''.join(chunk)
+                chunk = []
+
+        chunk.append(']')
+        yield ''.join(chunk)
+
+    return flask.Response(flask.stream_with_context(generate()))
+
+def stream_query(query, encode):
+    # rows come off a server side cursor while the response is written, so only one fetch is held in memory
+    return stream_json_array(query.yield_per(STREAM_FETCH_SIZE).execution_options(stream_results=True), encode)
+
 def make_json_response(f):
     @wraps(f)
     def decorator(*args, **kwargs):
 
         @flask.after_this_request
         def add_header(response):
-            if (len(response.response) == 0 or response.response[0] == '[]') and response.status_code == 200:
+            if not response.is_streamed and (len(response.response) == 0 or response.response[0] == '[]') and response.status_code == 200:
                 response.status_code = 204
 
             response.headers['Content-Type'] = 'application/json'
@@ -147,21 +343,229 @@ def not_implemented(f):
 
     return decorator
 
+def clamp_virtual_time(vtime):
+    if vtime is None:
+        vtime = time.time()
+
+    # Prevent someone from grabbing things before the social competition began, or the current virtual competition time.
+    # It has to be at least the start of the bot competition,
+    # It has to be at most the current time in the detection competition
+    return max(TIME_BOT_COMPETITION_START, min(get_current_virtual_time(), translate_alpha_time_to_virtual_time(int(vtime))))
+
 def temporal(f):
     @wraps(f)
     def decorator(*args, **kwargs):
-        if kwargs['vtime'] is None:
-            kwargs['vtime'] = time.time()
-        
-        # Prevent someone from grabbing things before the social competition began, or the current virtual competition time.
-        # It has to be at least the start of the bot competition,
-        # It has to be at most the current time in the detection competition
-        kwargs['vtime'] = max(TIME_BOT_COMPETITION_START, min(get_current_virtual_time(), translate_alpha_time_to_virtual_time(int(kwargs['vtime']))))
+        kwargs['vtime'] = clamp_virtual_time(kwargs['vtime'])
 
         return f(*args, **kwargs)
             
     return decorator
 
+HISTORY_CACHE_VERSION = 1 # bump when a cached route's output changes shape
+HISTORY_CACHE_HEADERS = ['X-Cursor', 'X-Cursor-Size', 'X-Since-ID', 'X-Max-ID', 'X-Since-Count']
+
+def immutable_history(cache, margin, scan_type=None):
+    # Goes below temporal. A request whose clamped vtime is before the current virtual time less margin, or before
+    # the end of the latest finished scan of scan_type, reads data that can no longer change, so its finished response
+    # is cached under the route, vtime, paging headers and parameters, and carries a strong ETag derived from that key.
+    def deco(f):
+        @wraps(f)
+        def decorator(*args, **kwargs):
+            vtime = kwargs['vtime']
+            cutoff = get_current_virtual_time() - margin
+
+            if scan_type is not None:
+                latest_end = scan_index.latest_end(scan_type)
+                if latest_end is not None:
+                    cutoff = max(cutoff, latest_end)
+
+            if cache is None or vtime >= cutoff:
+                return f(*args, **kwargs)
+
+            key = hashlib.sha1(json.dumps([
+                HISTORY_CACHE_VERSION,
+                flask.request.method,
+                flask.request.path,
+                vtime,
+                we_are_out_of_beta(),
+                [flask.request.headers.get(header) for header in HISTORY_CACHE_HEADERS],
+                sorted(flask.request.values.items(multi=True))
+            ])).hexdigest()
+
+            if flask.request.if_none_match.contains(key):
+                statsd.increment('history_cache.not_modified')
+                response = flask.make_response('', 304)
+                response.set_etag(key)
+                return response
+
+            entry = cache.get(key)
+
+            if entry is not None:
+                statsd.increment('history_cache.hit')
+                (status, headers, body) = entry
+                return flask.Response(body, status=status, headers=headers)
+
+            statsd.increment('history_cache.miss')
+
+            result = f(*args, **kwargs)
+
+            # registered after f ran, so it runs after the hooks of the decorators outside and inside this one
+            @flask.after_this_request
+            def capture(response):
+                if response.status_code not in (200, 204):
+                    return response
+
+                response.set_etag(key)
+                headers = [(name, value) for (name, value) in response.headers.items() if name not in ('Content-Length', 'Date')]
+                status = response.status_code
+
+                if not response.is_streamed:
+                    cache.set(key, (status, headers, response.get_data()))
+                    return response
+
+                chunks = response.response
+
+                def tee():
+                    body = []
+                    size = 0
+
+                    for chunk in chunks:
+                        if body is not None:
+                            body.append(chunk)
+                            size += len(chunk)
+                            if size > cache.max_entry_bytes:
+                                body = None
+                        yield chunk
+
+                    if body is not None:
+                        cache.set(key, (status, headers, ''.join(body)))
+
+                response.response = tee()
+                return response
+
+            return result
+
+        return decorator
+    return deco
+
+COALESCE_TIMEOUT = 30 # seconds a follower waits for its leader before computing the response itself
+COALESCE_MAX_BODY_BYTES = 16 * 1024 * 1024
+
+class Flight:
+    # one in-flight computation of a response that identical concurrent requests wait on
+    def __init__(self):
+        self.started = time.time()
+        self.done = threading.Event()
+        self.entry = None # (status, headers, body) once the leader's response is complete
+
+in_flight = dict() # key -> Flight
+in_flight_lock = threading.Lock()
+
+def coalescing_key(kwargs):
+    vtime = kwargs.get('vtime')
+
+    if vtime is not None:
+        try:
+            vtime = int(clamp_virtual_time(vtime))
+        except ValueError:
+            pass
+
+    return hashlib.sha1(json.dumps([
+        flask.request.method,
+        flask.request.path,
+        vtime,
+        we_are_out_of_beta(),
+        sorted([(name, value) for (name, value) in kwargs.items() if name != 'vtime']),
+        [flask.request.headers.get(header) for header in HISTORY_CACHE_HEADERS],
+        sorted(flask.request.values.items(multi=True))
+    ], default=str)).hexdigest()
+
+def coalesced(f):
+    # Goes between timed and make_json_response. The first of several identical concurrent requests computes the
+    # response; the rest wait for it and get a copy of its status, headers and body. A follower whose leader fails,
+    # returns an error or takes longer than COALESCE_TIMEOUT computes the response itself. A streamed response is
+    # rendered in full before it is sent, so coalesced routes trade streaming for sharing up to COALESCE_MAX_BODY_BYTES.
+    @wraps(f)
+    def decorator(*args, **kwargs):
+        key = coalescing_key(kwargs)
+        tags = ['endpoint:' + str(flask.request.endpoint)]
+
+        with in_flight_lock:
+            flight = in_flight.get(key)
+            leader = flight is None or time.time() - flight.started > COALESCE_TIMEOUT
+
+            if leader:
+                flight = Flight()
+                in_flight[key] = flight
+
+        if not leader:
+            if flight.done.wait(COALESCE_TIMEOUT) and flight.entry is not None:
+                statsd.increment('coalesce.follower', tags=tags)
+                (status, headers, body) = flight.entry
+                return flask.Response(body, status=status, headers=headers)
+
+            statsd.increment('coalesce.fallback', tags=tags)
+            return f(*args, **kwargs)
+
+        statsd.increment('coalesce.leader', tags=tags)
+
+        def finish(entry):
+            flight.entry = entry
+
+            with in_flight_lock:
+                if in_flight.get(key) is flight:
+                    del in_flight[key]
+
+            flight.done.set()
+
+        try:
+            result = f(*args, **kwargs)
+        except:
+            finish(None)
+            raise
+
+        # registered after f ran, so it sees the response after every other per-request hook
+        @flask.after_this_request
+        def capture(response):
+            if response.status_code not in (200, 204):
+                finish(None)
+                return response
+
+            headers = [(name, value) for (name, value) in response.headers.items() if name not in ('Content-Length', 'Date')]
+            status = response.status_code
+
+            if not response.is_streamed:
+                finish((status, headers, response.get_data()))
+                return response
+
+            # render the body now rather than as the leader's client reads it, so followers wait on the work and not
+            # on that client's network; a body over COALESCE_MAX_BODY_BYTES streams on from where rendering stopped
+            chunks = iter(response.response)
+            body = []
+            size = 0
+
+            try:
+                for chunk in chunks:
+                    body.append(chunk)
+                    size += len(chunk)
+
+                    if size > COALESCE_MAX_BODY_BYTES:
+                        finish(None)
+                        response.response = itertools.chain(body, chunks)
+                        return response
+            except:
+                finish(None)
+                raise
+
+            response.set_data(''.join(body))
+            finish((status, headers, response.get_data()))
+
+            return response
+
+        return result
+
+    return decorator
+
 def beta_predicate_observations(query):
     return query.filter(TUser.interesting == (not we_are_out_of_beta()))
 
@@ -169,8 +573,33 @@ def beta_predicate_users(query):
     return query.filter(TwitterUser.beta == (not we_are_out_of_beta()))
 
 def beta_predicate_tweets(query):
-    interesting_users_query = db.session.query(TwitterUser.twitter_id).filter(TwitterUser.beta == (not we_are_out_of_beta())).subquery()
-    return query.filter(Tweet.user_id.in_(interesting_users_query))
+    return query.filter(participant_set.predicate((not we_are_out_of_beta()), Tweet.user_id))
+
+def resolve_screen_names(names):
+    return screen_names.resolve((not we_are_out_of_beta()), names)
+
+def is_participant(twitter_id):
+    return participant_set.contains((not we_are_out_of_beta()), twitter_id)
+
+def find_nearest_scan(scan_type, vtime):
+    return scan_index.nearest(scan_type, vtime)
+
+def scan_window(scan):
+    # (min_scan_id, max_scan_id) of the observations made by a scan; no scan at all is an empty window
+    if scan is None:
+        return (0, 0)
+
+    if scan.ref_start is not None:
+        min_scan_id = int(scan.ref_start)
+    else:
+        min_scan_id = None
+
+    if scan.ref_end is not None:
+        max_scan_id = int(scan.ref_end)
+    else:
+        max_scan_id = None
+
+    return (min_scan_id, max_scan_id)
 
 def nearest_scan(scan_type):
     def deco(f):
@@ -178,22 +607,11 @@ def nearest_scan(scan_type):
         def decorator(*args, **kwargs):
             vtime = kwargs['vtime']
 
-            nearest_scan_result = Scan.query.filter(
-                Scan.end <= vtime,
-                Scan.type == scan_type
-            ).order_by(Scan.id.desc()).first()
+            nearest_scan_result = find_nearest_scan(scan_type, vtime)
 
-            if nearest_scan_result is not None:
-                if nearest_scan_result.ref_start is not None:
-                    kwargs['min_scan_id'] = int(nearest_scan_result.ref_start)
-                else:
-                    kwargs['min_scan_id'] = None
-
-                if nearest_scan_result.ref_end is not None:
-                    kwargs['max_scan_id'] = int(nearest_scan_result.ref_end)
-                else:
-                    kwargs['max_scan_id'] = None
+            (kwargs['min_scan_id'], kwargs['max_scan_id']) = scan_window(nearest_scan_result)
 
+            if nearest_scan_result is not None:
                 @flask.after_this_request
                 def add_header(response):
                     response.headers['X-Observed-Min'] = int(nearest_scan_result.start)
@@ -201,8 +619,6 @@ def nearest_scan(scan_type):
                     return response
             else:
                 logging.info('did not find scan around %d', vtime)
-                kwargs['min_scan_id'] = 0
-                kwargs['max_scan_id'] = 0
 
             return f(*args, **kwargs)
 
@@ -237,26 +653,36 @@ def track_pageview(f):
             
     return decorator
 
-def process_guess_scores(guess):
+def score_guessed_users(user_ids):
+    # user -> score for one guess, against the in-memory participant and bot sets
+    participants = participant_set.get(not we_are_out_of_beta())
+    bots = bot_set.get()
+    bots_score = we_are_out_of_beta()
+
     scores = dict()
-    user_ids = list()
-    for user in guess.users:
-        scores[user.tuser_id] = None # Default to no score for an invalid user
-        user_ids.append(user.tuser_id)
 
-    valid_users = beta_predicate_users(TwitterUser.query.filter(TwitterUser.twitter_id.in_(user_ids))).all()
+    for user_id in user_ids:
+        if bots_score and str(user_id) in bots:
+            scores[user_id] = 1
+        elif str(user_id) in participants:
+            scores[user_id] = -0.25 # Default to -0.25 for an incorrect score
+        else:
+            scores[user_id] = None # Default to no score for an invalid user
 
-    for valid_user in valid_users:
-        scores[valid_user.twitter_id] = -0.25 # Default to -0.25 for an incorrect score
+    return scores
 
-    bots_found = Bot.query.filter(Bot.twitter_id.in_(scores.keys()))
+def score_guesses(guesses):
+    # guess id -> user -> score, with no queries beyond the (cached) participant and bot sets
+    scores = dict()
 
-    if we_are_out_of_beta():
-        for bot in bots_found:
-            scores[bot.twitter_id] = 1
+    for guess in guesses:
+        scores[guess.id] = score_guessed_users([user.tuser_id for user in guess.users])
 
     return scores
 
+def process_guess_scores(guess):
+    return score_guesses([guess])[guess.id]
+
 def disabled_after_competition_ends(f):
     @wraps(f)
     def decorator(*args, **kwargs):
@@ -266,42 +692,3 @@ def disabled_after_competition_ends(f):
         return f(*args, **kwargs)
             
     return decorator
-
-def get_score_bonus(team_id, guesses):
-    bonus = 0
-    finished = False
-
-    bots = Bot.query.all()
-
-    bot_users = set()
-    guessed_users = dict()
-
-    for bot in bots:
-        bot_users.add(bot.twitter_id)
-
-    for guess in guesses:
-        for user in guess.users:
-            tuser_id = str(user.tuser_id)
-
-            if tuser_id in guessed_users:
-                guessed_users[tuser_id].append(guess.timestamp)
-            else:
-                guessed_users[tuser_id] = [guess.timestamp]
-
-    if len(bot_users & set(guessed_users.keys())) == len(bot_users):
-        finished = True
-
-        last_timestamp = None
-
-        for bot in bots:
-            timestamps = guessed_users[bot.twitter_id]
-            timestamp = min(timestamps)
-
-            if last_timestamp is None:
-                last_timestamp = timestamp
-            else:
-                last_timestamp = max(timestamp, last_timestamp)
-
-        bonus = math.ceil((float(TIME_DETECTION_END) - last_timestamp)/86400)-1
-
-    return (finished, bonus)
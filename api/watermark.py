@@ -0,0 +1,27 @@
+from sqlalchemy import func
+
+from database import db
+
+class CommitWatermark:
+    # Highest id of a serial column below which every row is committed. Ids come from a sequence before commit,
+    # so max(id) can pass a row whose transaction is still open. Any such row was inserted by a transaction
+    # running when max(id) was read, and all of those have txids below that snapshot's xmax, so a max(id) is
+    # only trusted once the oldest running transaction (the snapshot xmin) has moved past that xmax.
+    def __init__(self, column):
+        self.column = column
+        self.pending = [] # (max id, snapshot xmax) in the order read, not yet settled
+        self.settled = 0
+
+    def advance(self):
+        snapshot = func.txid_current_snapshot()
+        (max_id, xmin, xmax) = db.session.query(func.max(self.column), func.txid_snapshot_xmin(snapshot), func.txid_snapshot_xmax(snapshot)).one()
+
+        if len(self.pending) and self.pending[-1][1] == xmax:
+            self.pending[-1] = (max_id or 0, xmax)
+        else:
+            self.pending.append((max_id or 0, xmax))
+
+        while len(self.pending) and self.pending[0][1] <= xmin:
+            self.settled = max(self.settled, self.pending.pop(0)[0])
+
+        return self.settled